@@ -0,0 +1,28 @@
+"""Add guardian leases
+
+Revision ID: 1c9d4e6f2a57
+Revises: 5b2e7d1c8a03
+Create Date: 2026-10-16 20:15:09.554120
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1c9d4e6f2a57'
+down_revision = '5b2e7d1c8a03'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'guardian_leases',
+        sa.Column('name', sa.String(64), primary_key=True),
+        sa.Column('holder', sa.String(255), nullable=False),
+        sa.Column('expires_at', sa.DateTime, nullable=False))
+
+
+def downgrade():
+    op.drop_table('guardian_leases')
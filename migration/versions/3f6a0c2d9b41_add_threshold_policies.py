@@ -0,0 +1,35 @@
+"""Add threshold policies
+
+Revision ID: 3f6a0c2d9b41
+Revises: 2d19bced283e
+Create Date: 2026-10-16 19:50:12.402215
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3f6a0c2d9b41'
+down_revision = '2d19bced283e'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'threshold_policies',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('kind', sa.String(16), nullable=False),
+        sa.Column('pattern', sa.String(255), nullable=True),
+        sa.Column('owner_id', sa.Integer, sa.ForeignKey('pulse_users.id'),
+                  nullable=True),
+        sa.Column('rank', sa.Integer, nullable=False, server_default='0'),
+        sa.Column('warn_queue_size', sa.Integer, nullable=True),
+        sa.Column('del_queue_size', sa.Integer, nullable=True),
+        sa.Column('updated_at', sa.DateTime, nullable=False,
+                  server_default=sa.func.now()))
+
+
+def downgrade():
+    op.drop_table('threshold_policies')
@@ -0,0 +1,29 @@
+"""Add vhost field on queue
+
+Revision ID: 4a8b3e5f7c12
+Revises: 1c9d4e6f2a57
+Create Date: 2026-10-16 20:31:44.906518
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4a8b3e5f7c12'
+down_revision = '1c9d4e6f2a57'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # The records of queues outside the default vhost get replaced by
+    # correct ones at the guardian's next reconciliation.
+    op.add_column('queues', sa.Column('vhost', sa.String(255),
+                                      nullable=False, server_default='/'))
+    op.create_index('ix_queues_name_vhost', 'queues', ['name', 'vhost'])
+
+
+def downgrade():
+    op.drop_index('ix_queues_name_vhost', table_name='queues')
+    op.drop_column('queues', 'vhost')
@@ -0,0 +1,28 @@
+"""Add guardian workers
+
+Revision ID: 5b2e7d1c8a03
+Revises: 3f6a0c2d9b41
+Create Date: 2026-10-16 20:02:37.118204
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5b2e7d1c8a03'
+down_revision = '3f6a0c2d9b41'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'guardian_workers',
+        sa.Column('id', sa.String(255), primary_key=True),
+        sa.Column('heartbeat', sa.DateTime, nullable=False,
+                  server_default=sa.func.now()))
+
+
+def downgrade():
+    op.drop_table('guardian_workers')
@@ -0,0 +1,92 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from multiprocessing.pool import ThreadPool
+
+# Waiting on a result with a timeout, however long, keeps the waiting thread
+# responsive to signals (e.g. SIGTERM) under Python 2.
+WAIT_TIMEOUT = 24 * 60 * 60
+
+
+def wait(result, timeout=WAIT_TIMEOUT):
+    """Returns the value of an asynchronous call, re-raising its exception
+    if it failed.
+    """
+    return result.get(timeout)
+
+
+class AsyncPulseManagementAPI(object):
+    """Non-blocking front end to a PulseManagementAPI.
+
+    Calls are run on a pool of threads and return at once an AsyncResult
+    (see multiprocessing.pool), whose get() method returns the call's value
+    or raises its exception.  The requests themselves are made by the
+    wrapped PulseManagementAPI, so they share its connection pool, retries
+    and circuit breaker.
+
+    :param api: An instance of PulseManagementAPI.
+    :param workers: Number of threads; defaults to api.workers.
+    """
+
+    def __init__(self, api, workers=None):
+        self.api = api
+        self.exception = api.exception
+        self.pool = ThreadPool(workers or api.workers)
+
+    def submit(self, func, *args, **kwargs):
+        """Calls func(*args, **kwargs) on the pool."""
+        return self.pool.apply_async(func, args, kwargs)
+
+    def queue_snapshots(self, vhost=None, page_size=0, stream=False):
+        """Lists the queues as QueueSnapshots (see
+        PulseManagementAPI.queue_snapshots); the listing is fully fetched
+        by the pool.
+        """
+        return self.submit(lambda: list(self.api.queue_snapshots(
+            vhost, page_size=page_size, stream=stream)))
+
+    def vhost_snapshots(self, vhosts, page_size=0, stream=False):
+        """Lists the queues of each vhost separately and concurrently.  If
+        the API has several nodes, the listings are spread over the healthy
+        ones, so that a slow node doesn't hold up every listing.
+
+        Returns an iterator over (vhost, queues, error) tuples, in the order
+        the listings complete, so that a large vhost doesn't hold up the
+        others: queues is a list of QueueSnapshots, or None if the listing
+        failed with error (an instance of api.exception).
+        """
+        nodes = self.api.available_nodes()
+
+        def fetch(item):
+            i, vhost = item
+            api = self.api
+            if len(nodes) > 1:
+                api = api.on_node(nodes[i % len(nodes)])
+            try:
+                return vhost, list(api.queue_snapshots(
+                    vhost, page_size=page_size, stream=stream)), None
+            except self.exception as e:
+                return vhost, None, e
+
+        vhosts = list(vhosts)
+        listings = self.pool.imap_unordered(fetch, enumerate(vhosts))
+        for _ in vhosts:
+            yield listings.next(WAIT_TIMEOUT)
+
+    def queue(self, vhost, queue):
+        return self.submit(self.api.queue, vhost, queue)
+
+    def bindings(self, vhost=None):
+        return self.submit(lambda: list(self.api.bindings(vhost)))
+
+    def delete_queue(self, vhost, queue):
+        return self.submit(self.api.delete_queue, vhost, queue)
+
+    def delete_queues(self, queues):
+        return self.submit(self.api.delete_queues, list(queues))
+
+    def close(self):
+        """Waits for the pending calls and stops the threads."""
+        self.pool.close()
+        self.pool.join()
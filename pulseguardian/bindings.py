@@ -0,0 +1,67 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import logging
+import time
+
+from pulseguardian import config
+
+
+class ExchangeResolver(object):
+    """Finds the exchange a queue is bound to, from an in-memory index of
+    every binding on the broker.
+
+    The index is built from a single listing of the bindings, fetched the
+    first time it's needed and refreshed once it's older than ttl seconds,
+    so looking up many queues costs at most one request.
+
+    :param api: An instance of PulseManagementAPI.
+    :param ttl: Maximum age of the index, in seconds.
+    """
+
+    def __init__(self, api, ttl=config.bindings_ttl):
+        self.api = api
+        self.ttl = ttl
+        self._index = None
+        self._fetched_at = 0
+
+    def invalidate(self):
+        """Forces the index to be refreshed on the next lookup."""
+        self._fetched_at = 0
+
+    def _refresh(self):
+        index = {}
+        for binding in self.api.bindings():
+            # Every queue is implicitly bound to the default exchange ('');
+            # that's never the one we're interested in.
+            if binding.get('destination_type') != 'queue':
+                continue
+            if not binding.get('source'):
+                continue
+            key = (binding.get('vhost'), binding['destination'])
+            index.setdefault(key, binding['source'])
+        self._index = index
+        self._fetched_at = time.time()
+
+    def prefetch(self):
+        """Refreshes the index if it's older than the TTL, e.g. ahead of
+        the lookups of a guardian cycle.
+        """
+        if time.time() - self._fetched_at > self.ttl:
+            try:
+                self._refresh()
+            except self.api.exception:
+                logging.exception("Couldn't list the bindings.")
+                # Don't retry on every lookup; keep the stale index, if any.
+                self._fetched_at = time.time()
+
+    def exchange(self, vhost, queue):
+        """Returns the name of the (first) exchange the queue is bound to,
+        or None if it isn't bound to any or the bindings couldn't be
+        fetched.
+        """
+        self.prefetch()
+        if self._index is None:
+            return None
+        return self._index.get((vhost, queue))
@@ -25,6 +25,14 @@ email_from = os.getenv('EMAIL_FROM', 'Mozilla A-Team <auto-tools@mozilla.com>')
 email_smtp_server = os.getenv('EMAIL_SMTP_SERVER', 'smtp.mozilla.org')
 email_smtp_port = int(os.getenv('EMAIL_SMTP_PORT', 25))
 email_ssl = bool(int(os.getenv('EMAIL_SSL', 0)))
+# Emails are sent in the background by a pool of workers.
+email_workers = int(os.getenv('EMAIL_WORKERS', 2))
+email_max_pending = int(os.getenv('EMAIL_MAX_PENDING', 1000))
+email_batch_size = int(os.getenv('EMAIL_BATCH_SIZE', 50))
+# If non-zero, the notifications sent to each recipient within that many
+# seconds are coalesced into a single digest email.
+email_digest_window = int(os.getenv('EMAIL_DIGEST_WINDOW', 0))
+email_shutdown_timeout = float(os.getenv('EMAIL_SHUTDOWN_TIMEOUT', 30))
 
 # Database
 database_url = os.getenv('DATABASE_URL',
@@ -32,16 +40,88 @@ database_url = os.getenv('DATABASE_URL',
 pool_recycle_interval = int(os.getenv('POOL_RECYCLE_INTERVAL', 60))
 
 # RabbitMQ
+# Several comma-separated URLs can be given for the nodes of a cluster.
 rabbit_management_url = os.getenv('RABBIT_MANAGEMENT_URL',
                                   'http://localhost:15672/api')
+rabbit_host = os.getenv('RABBIT_HOST', 'localhost')
+rabbit_port = int(os.getenv('RABBIT_PORT', 5672))
 rabbit_vhost = os.getenv('RABBIT_VHOST', '/')
 rabbit_user = os.getenv('RABBIT_USER', 'guest')
 rabbit_password = os.getenv('RABBIT_PASSWORD', 'guest')
+rabbit_connect_timeout = float(os.getenv('RABBIT_CONNECT_TIMEOUT', 5))
+rabbit_read_timeout = float(os.getenv('RABBIT_READ_TIMEOUT', 30))
+rabbit_backoff_base = float(os.getenv('RABBIT_BACKOFF_BASE', 0.5))
+rabbit_backoff_max = float(os.getenv('RABBIT_BACKOFF_MAX', 10))
+rabbit_breaker_threshold = int(os.getenv('RABBIT_BREAKER_THRESHOLD', 5))
+rabbit_breaker_reset_timeout = float(
+    os.getenv('RABBIT_BREAKER_RESET_TIMEOUT', 30))
+# Concurrent requests made by bulk operations (e.g. deleting many queues).
+rabbit_workers = int(os.getenv('RABBIT_WORKERS', 10))
 
 # PulseGuardian
 warn_queue_size = int(os.getenv('WARN_QUEUE_SIZE', 2000))
 del_queue_size = int(os.getenv('DEL_QUEUE_SIZE', 8000))
+# Thresholds, in bytes, on the size of a queue's messages, on the size of
+# those held in RAM and on the memory used by the queue (0 to disable).
+warn_queue_bytes = int(os.getenv('WARN_QUEUE_BYTES', 0))
+del_queue_bytes = int(os.getenv('DEL_QUEUE_BYTES', 0))
+warn_queue_bytes_ram = int(os.getenv('WARN_QUEUE_BYTES_RAM', 0))
+del_queue_bytes_ram = int(os.getenv('DEL_QUEUE_BYTES_RAM', 0))
+warn_queue_memory = int(os.getenv('WARN_QUEUE_MEMORY', 0))
+del_queue_memory = int(os.getenv('DEL_QUEUE_MEMORY', 0))
+# Owners are warned, and queues deleted, when their growth rate projects them
+# to reach DEL_QUEUE_SIZE within that many seconds (0 to disable).
+predictive_warn_horizon = float(os.getenv('PREDICTIVE_WARN_HORIZON', 0))
+predictive_del_horizon = float(os.getenv('PREDICTIVE_DEL_HORIZON', 0))
+# Seconds after which a cycle leaves the queues that only need bookkeeping for
+# the next one, so that deletions and warnings aren't delayed (0: no limit).
+cycle_time_budget = float(os.getenv('CYCLE_TIME_BUDGET', 0))
 polling_interval = int(os.getenv('POLLING_INTERVAL', 5))
+# Bounds of the polling interval, which shrinks when queues grow towards the
+# thresholds and grows when it's quiet; both default to POLLING_INTERVAL.
+polling_interval_min = float(os.getenv('POLLING_INTERVAL_MIN',
+                                       polling_interval))
+polling_interval_max = float(os.getenv('POLLING_INTERVAL_MAX',
+                                       polling_interval))
+snapshot_resync_interval = int(os.getenv('SNAPSHOT_RESYNC_INTERVAL', 300))
+# Listing the queues in pages (0 to disable) lowers the broker's load, at the
+# cost of a possibly inconsistent view when queues come and go meanwhile.
+queue_page_size = int(os.getenv('QUEUE_PAGE_SIZE', 0))
+stream_queues = bool(int(os.getenv('STREAM_QUEUES', 0)))
+# List the queues of each vhost separately and concurrently, enforcing the
+# thresholds on each vhost as soon as its listing arrives.  Only supported by
+# the default and asynchronous loops (not with EVENT_TRACKING or
+# PIPELINED_GUARD).
+parallel_vhosts = bool(int(os.getenv('PARALLEL_VHOSTS', 0)))
+# Maximum age, in seconds, of the bindings used to name queues' exchanges.
+bindings_ttl = int(os.getenv('BINDINGS_TTL', 60))
+# Fetch the data of each cycle concurrently and start cycles at a fixed rate.
+async_guard = bool(int(os.getenv('ASYNC_GUARD', 0)))
+# Fetch the queues in a background thread while the previous listing is being
+# processed; only the latest PIPELINE_BUFFER_SIZE listings are kept.
+pipelined_guard = bool(int(os.getenv('PIPELINED_GUARD', 0)))
+pipeline_buffer_size = int(os.getenv('PIPELINE_BUFFER_SIZE', 1))
+# Track new and deleted queues from the events of amq.rabbitmq.event (needs
+# the rabbitmq_event_exchange plugin); the listings then only reconcile the
+# records of vanished queues every EVENT_REPAIR_INTERVAL seconds.
+event_tracking = bool(int(os.getenv('EVENT_TRACKING', 0)))
+event_repair_interval = int(os.getenv('EVENT_REPAIR_INTERVAL', 300))
+# Split the queues between every guardian started with SHARDED_GUARD=1, by
+# consistent hashing of their names.  Workers refresh a heartbeat in the
+# database at every cycle and are considered gone after
+# SHARD_HEARTBEAT_TIMEOUT seconds without one.
+sharded_guard = bool(int(os.getenv('SHARDED_GUARD', 0)))
+guardian_worker_id = os.getenv('GUARDIAN_WORKER_ID', None)
+shard_heartbeat_timeout = int(os.getenv('SHARD_HEARTBEAT_TIMEOUT', 60))
+# Only one of the guardians started with LEADER_ELECTION=1 is active at a
+# time, through a PostgreSQL advisory lock or, on other databases, a lease of
+# LEADER_LEASE_TTL seconds (longer than POLLING_INTERVAL_MAX) renewed at every
+# cycle and before deleting queues.  Standbys try to take over every
+# LEADER_RETRY_INTERVAL seconds.
+leader_election = bool(int(os.getenv('LEADER_ELECTION', 0)))
+leader_lock_id = int(os.getenv('LEADER_LOCK_ID', 1886745715))
+leader_lease_ttl = int(os.getenv('LEADER_LEASE_TTL', 30))
+leader_retry_interval = float(os.getenv('LEADER_RETRY_INTERVAL', 5))
 fake_account = os.getenv('FAKE_ACCOUNT', None)
 
 # Logging
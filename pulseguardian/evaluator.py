@@ -0,0 +1,184 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Evaluation of the warning and deletion thresholds over many queues at
+once.
+
+Sizes, resource usages, growth rates and warned flags are packed into arrays
+and compared to the thresholds in a few vectorized operations with NumPy if
+it's installed, otherwise in a single loop over compact arrays of the array
+module.
+"""
+
+import collections
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+INFINITY = float('inf')
+NAN = float('nan')
+
+# Indices of the evaluated queues, by outcome.  The queues to delete, warn
+# and declare back to normal are ordered by projected time to deletion;
+# rest holds every other queue.
+Evaluation = collections.namedtuple('Evaluation',
+                                    'delete warn normal rest')
+
+
+class ThresholdEvaluator(object):
+    """Classifies queues against the warning and deletion thresholds.
+
+    :param warn_queue_size: Warning threshold.
+    :param del_queue_size: Deletion threshold.
+    :param warn_horizon: Queues projected to reach the deletion threshold
+                         within that many seconds are warned.
+    :param del_horizon: Queues projected to reach the deletion threshold
+                        within that many seconds are deleted.
+    :param limits: Dict of (warning, deletion) thresholds on resource
+                   usages (see snapshot.RESOURCE_METRICS), by metric; a
+                   threshold of 0 is disabled.  A queue over any of them is
+                   warned or deleted like a queue over the message count
+                   thresholds.
+    :param use_numpy: Whether to use NumPy; defaults to True if it's
+                      installed.
+    """
+
+    def __init__(self, warn_queue_size, del_queue_size, warn_horizon=0,
+                 del_horizon=0, limits=None, use_numpy=None):
+        self.warn_queue_size = warn_queue_size
+        self.limits = dict((metric, thresholds) for metric, thresholds
+                           in (limits or {}).iteritems() if any(thresholds))
+        self.del_queue_size = del_queue_size
+        self.warn_horizon = warn_horizon
+        self.del_horizon = del_horizon
+        if use_numpy is None:
+            use_numpy = numpy is not None
+        self.use_numpy = use_numpy
+
+    def evaluate(self, sizes, rates, warned, warn_sizes=None,
+                 del_sizes=None, usages=None):
+        """Returns an Evaluation of queues given as parallel sequences.
+
+        :param sizes: Numbers of messages; None if unknown, in which case
+                      the queue is left alone.
+        :param rates: Growth rates, in messages per second.
+        :param warned: Whether each queue's owner was already warned
+                       (None counts as False).
+        :param warn_sizes: Warning threshold of each queue, if they're not
+                           all the evaluator's.
+        :param del_sizes: Deletion threshold of each queue, likewise.
+        :param usages: Dict of the resource usage of each queue (None if
+                       unknown), by metric, for the metrics in limits.
+        """
+        usages = usages or {}
+        if self.use_numpy:
+            return self._evaluate_numpy(sizes, rates, warned, warn_sizes,
+                                        del_sizes, usages)
+        return self._evaluate_array(sizes, rates, warned, warn_sizes,
+                                    del_sizes, usages)
+
+    def _evaluate_numpy(self, sizes, rates, warned, warn_sizes, del_sizes,
+                        usages):
+        sizes = numpy.array([NAN if size is None else size
+                             for size in sizes], dtype=numpy.float64)
+        rates = numpy.asarray(rates, dtype=numpy.float64)
+        warned = numpy.asarray(warned, dtype=bool)
+        warn_size = self.warn_queue_size
+        if warn_sizes is not None:
+            warn_size = numpy.asarray(warn_sizes, dtype=numpy.float64)
+        del_size = self.del_queue_size
+        if del_sizes is not None:
+            del_size = numpy.asarray(del_sizes, dtype=numpy.float64)
+
+        # Comparisons with NaN (unknown sizes) are False, as intended.
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            eta = numpy.where(rates > 0, (del_size - sizes) / rates,
+                              INFINITY)
+            over_del = sizes > del_size
+            eta[over_del] = 0
+            delete = over_del | (eta < self.del_horizon)
+            overgrowing = (sizes > warn_size) | (eta < self.warn_horizon)
+            for metric, (warn_limit, del_limit) in self.limits.iteritems():
+                if metric not in usages:
+                    continue
+                usage = numpy.array([NAN if value is None else value
+                                     for value in usages[metric]],
+                                    dtype=numpy.float64)
+                if warn_limit:
+                    overgrowing |= usage > warn_limit
+                if del_limit:
+                    over_limit = usage > del_limit
+                    eta[over_limit] = 0
+                    delete |= over_limit
+        delete &= ~numpy.isnan(sizes)
+        warn = ~delete & overgrowing & ~warned
+        normal = (~delete & ~overgrowing & warned &
+                  ~numpy.isnan(sizes))
+        rest = ~(delete | warn | normal)
+
+        def ordered(mask):
+            indices = numpy.flatnonzero(mask)
+            return indices[numpy.argsort(eta[indices],
+                                         kind='mergesort')].tolist()
+
+        return Evaluation(ordered(delete), ordered(warn), ordered(normal),
+                          numpy.flatnonzero(rest).tolist())
+
+    def _evaluate_array(self, sizes, rates, warned, warn_sizes, del_sizes,
+                        usages):
+        sizes = array('d', (NAN if size is None else size
+                            for size in sizes))
+        rates = array('d', rates)
+        # Flags of records never warned may be None.
+        warned = array('b', (bool(flag) for flag in warned))
+        if warn_sizes is not None:
+            warn_sizes = array('d', warn_sizes)
+        if del_sizes is not None:
+            del_sizes = array('d', del_sizes)
+        warn_size, del_size = self.warn_queue_size, self.del_queue_size
+        warn_horizon, del_horizon = self.warn_horizon, self.del_horizon
+        limits = [(array('d', (NAN if value is None else value
+                               for value in usages[metric])),
+                   warn_limit, del_limit)
+                  for metric, (warn_limit, del_limit)
+                  in self.limits.iteritems() if metric in usages]
+
+        eta = array('d', [INFINITY]) * len(sizes)
+        delete, warn, normal, rest = [], [], [], []
+        for i in xrange(len(sizes)):
+            size, rate = sizes[i], rates[i]
+            if warn_sizes is not None:
+                warn_size = warn_sizes[i]
+            if del_sizes is not None:
+                del_size = del_sizes[i]
+            if size != size:
+                # Unknown size (NaN).
+                rest.append(i)
+                continue
+            if size > del_size:
+                eta[i] = 0
+            elif rate > 0:
+                eta[i] = (del_size - size) / rate
+            # Comparisons with NaN (unknown usages) are False.
+            over_warn_limit = any(warn_limit and usage[i] > warn_limit
+                                  for usage, warn_limit, del_limit in limits)
+            over_del_limit = any(del_limit and usage[i] > del_limit
+                                 for usage, warn_limit, del_limit in limits)
+            if over_del_limit:
+                eta[i] = 0
+
+            if size > del_size or over_del_limit or eta[i] < del_horizon:
+                delete.append(i)
+            elif (size > warn_size or eta[i] < warn_horizon or
+                  over_warn_limit):
+                (rest if warned[i] else warn).append(i)
+            else:
+                (normal if warned[i] else rest).append(i)
+
+        key = eta.__getitem__
+        return Evaluation(sorted(delete, key=key), sorted(warn, key=key),
+                          sorted(normal, key=key), rest)
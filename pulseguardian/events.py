@@ -0,0 +1,86 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Queue creation and deletion events, as published on amq.rabbitmq.event
+by RabbitMQ's event exchange plugin (rabbitmq_event_exchange).
+
+An event source has a drain(timeout) method returning the events received
+within timeout seconds (possibly fewer, as soon as some have arrived), a
+close() method and an exception attribute: the exception(s) drain raises
+when the events can't be received, in which case some may have been lost.
+"""
+
+import collections
+import socket
+
+import amqp
+
+from pulseguardian import config
+
+EVENT_EXCHANGE = 'amq.rabbitmq.event'
+
+# Event types, which are also the routing keys of the events.
+QUEUE_CREATED = 'queue.created'
+QUEUE_DELETED = 'queue.deleted'
+
+QueueEvent = collections.namedtuple('QueueEvent', 'type name vhost durable')
+
+
+class AmqpEventSource(object):
+    """Receives the queue events from the broker through an exclusive queue
+    bound to the event exchange.  The connection is (re)opened by drain()
+    when needed.
+    """
+
+    exception = (IOError, socket.error, amqp.AMQPError)
+
+    def __init__(self, host=config.rabbit_host, port=config.rabbit_port,
+                 vhost=config.rabbit_vhost, user=config.rabbit_user,
+                 password=config.rabbit_password):
+        self.host = host
+        self.port = port
+        self.vhost = vhost
+        self.user = user
+        self.password = password
+        self.connection = None
+        self._events = []
+
+    def connect(self):
+        self.connection = amqp.Connection(
+            host='{0}:{1}'.format(self.host, self.port), userid=self.user,
+            password=self.password, virtual_host=self.vhost)
+        channel = self.connection.channel()
+        queue, _, _ = channel.queue_declare(exclusive=True)
+        for event_type in (QUEUE_CREATED, QUEUE_DELETED):
+            channel.queue_bind(queue, EVENT_EXCHANGE, routing_key=event_type)
+        channel.basic_consume(queue, no_ack=True, callback=self._receive)
+
+    def _receive(self, message):
+        # The event's details are in the message's headers.
+        headers = message.properties.get('application_headers') or {}
+        self._events.append(QueueEvent(
+            message.delivery_info['routing_key'], headers.get('name'),
+            headers.get('vhost', '/'), bool(headers.get('durable'))))
+
+    def drain(self, timeout):
+        if self.connection is None:
+            self.connect()
+        try:
+            self.connection.drain_events(timeout=timeout)
+        except socket.timeout:
+            pass
+        except self.exception:
+            self.close()
+            raise
+        events, self._events = self._events, []
+        return events
+
+    def close(self):
+        if self.connection is None:
+            return
+        try:
+            self.connection.close()
+        except self.exception:
+            pass
+        self.connection = None
@@ -2,21 +2,76 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import itertools
 import logging
 import re
+import signal
+import sys
 import time
 
+from sqlalchemy.orm import joinedload_all
+
 from pulseguardian import config
+from pulseguardian.asyncapi import AsyncPulseManagementAPI, wait
+from pulseguardian.bindings import ExchangeResolver
+from pulseguardian.evaluator import ThresholdEvaluator
+from pulseguardian.events import AmqpEventSource, QUEUE_CREATED, QUEUE_DELETED
+from pulseguardian.leader import create_election
 from pulseguardian.logs import setup_logging
 from pulseguardian.management import PulseManagementAPI
 from pulseguardian.model.base import init_db, db_session
 from pulseguardian.model.models import PulseUser, Queue, User
-from pulseguardian.sendemail import sendemail
+from pulseguardian.model.staging import sync_queues
+from pulseguardian.notifier import DigestNotifier, Notifier
+from pulseguardian.pipeline import Handoff, SnapshotFetcher
+from pulseguardian.policy import ThresholdPolicies
+from pulseguardian.scheduler import PollingScheduler
+from pulseguardian.sharding import ShardCoordinator
+from pulseguardian.snapshot import QueueSnapshot
 
 logging.getLogger("requests").setLevel(logging.WARNING)
 
 setup_logging(config.guardian_log_path)
 
+# Maximum number of names in a single "IN" clause when loading records.
+LOAD_BATCH_SIZE = 500
+
+# Order in which the queues are handled during a cycle: those to delete,
+# then those whose owner must be warned (or told they're back to normal),
+# then those whose record only needs to be updated.
+PRIORITY_DELETE = 0
+PRIORITY_WARN = 1
+PRIORITY_BOOKKEEPING = 2
+
+# Level of the thresholds in a (warning, deletion) pair.
+WARN = 0
+DELETE = 1
+
+# How the resource usages are described to queue owners.
+RESOURCE_LABELS = {
+    'message_bytes': 'total size of its messages',
+    'message_bytes_ram': 'size of its messages held in memory',
+    'memory': 'memory use',
+}
+
+
+def configured_limits():
+    """Returns the (warning, deletion) thresholds on resource usages set
+    in the config, by metric.
+    """
+    return {
+        'message_bytes': (config.warn_queue_bytes, config.del_queue_bytes),
+        'message_bytes_ram': (config.warn_queue_bytes_ram,
+                              config.del_queue_bytes_ram),
+        'memory': (config.warn_queue_memory, config.del_queue_memory),
+    }
+
+
+def _batches(items, size):
+    items = list(items)
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
+
 
 class PulseGuardian(object):
     """Monitors RabbitMQ queues: assigns owners to queues, warn owners
@@ -25,14 +80,60 @@ class PulseGuardian(object):
 
     :param api: An instance of PulseManagementAPI, to communicate with rabbitmq.
     :param emails: Sends emails to queue owners if True.
-    :param warn_queue_size: Warning threshold.
-    :param del_queue_size: Deletion threshold.
+    :param warn_queue_size: Default warning threshold.
+    :param del_queue_size: Default deletion threshold.  Both can be
+                           overridden for some queues by ThresholdPolicies
+                           in the database.
     :param on_warn: Callback called with a queue's name when it's warned.
     :param on_delete: Callback called with a queue's name when it's deleted.
+    :param snapshot_resync_interval: Seconds after which the snapshot of the
+                                     previous cycle is discarded and every
+                                     queue is reconciled again.
+    :param queue_page_size: If non-zero, the queues are listed in pages of
+                            that many queues instead of all at once.
+    :param stream_queues: If True, the queue listing is decoded and
+                          processed one queue at a time instead of being
+                          loaded in memory all at once.
+    :param notifier: Notifier (or DigestNotifier) used to send emails in the
+                     background; one is created if None and emails is True.
+    :param scheduler: PollingScheduler choosing the delay between cycles;
+                      one is created from the config if None.  It also
+                      provides the queues' growth rates.
+    :param warn_horizon: Owners are warned when their queue's growth rate
+                         projects it to reach the deletion threshold within
+                         that many seconds, even if it's still below the
+                         warning threshold; 0 to disable.
+    :param del_horizon: Same as warn_horizon, but the queue is deleted.
+    :param limits: Dict of (warning, deletion) thresholds, in bytes, on the
+                   resource usages of snapshot.RESOURCE_METRICS, by
+                   metric; 0 disables a threshold.  Defaults to
+                   configured_limits().
+    :param cycle_budget: Seconds after which, during a cycle, the queues
+                         which only need their record updated are left for
+                         the next cycle; 0 for no limit.
+    :param shard: ShardCoordinator of this guardian if the queues are split
+                  between several workers, in which case only the queues of
+                  its shard are monitored; None to monitor every queue.
+    :param election: Election (see leader.py) among redundant guardians, of
+                     which only the leader polls RabbitMQ and acts on the
+                     queues; None if this guardian is the only one.
+    :param parallel_vhosts: If True, the queues of each vhost are listed
+                            separately and concurrently, and each vhost is
+                            monitored as soon as its listing arrives (see
+                            monitor_vhosts).
     """
     def __init__(self, api, emails=True, warn_queue_size=config.warn_queue_size,
                  del_queue_size=config.del_queue_size, on_warn=None,
-                 on_delete=None):
+                 on_delete=None,
+                 snapshot_resync_interval=config.snapshot_resync_interval,
+                 queue_page_size=config.queue_page_size,
+                 stream_queues=config.stream_queues, notifier=None,
+                 scheduler=None,
+                 warn_horizon=config.predictive_warn_horizon,
+                 del_horizon=config.predictive_del_horizon,
+                 limits=None, cycle_budget=config.cycle_time_budget,
+                 shard=None, election=None,
+                 parallel_vhosts=config.parallel_vhosts):
         if del_queue_size < warn_queue_size:
             raise ValueError("Deletion threshold can't be smaller than the "
                              "warning threshold.")
@@ -40,55 +141,233 @@ class PulseGuardian(object):
         self.api = api
 
         self.emails = emails
+        self.exchange_resolver = ExchangeResolver(api)
+        if notifier is None and emails:
+            notifier = Notifier()
+            if config.email_digest_window:
+                notifier = DigestNotifier(notifier)
+        self.notifier = notifier
         self.warn_queue_size = warn_queue_size
         self.del_queue_size = del_queue_size
+        self.warn_horizon = warn_horizon
+        self.del_horizon = del_horizon
+        self.cycle_budget = cycle_budget
+        self.shard = shard
+        self.election = election
+        if limits is None:
+            limits = configured_limits()
+        self.evaluator = ThresholdEvaluator(warn_queue_size, del_queue_size,
+                                            warn_horizon, del_horizon,
+                                            limits=limits)
+        # Enabled thresholds on resource usages only.
+        self.limits = self.evaluator.limits
+        self.policies = ThresholdPolicies(warn_queue_size, del_queue_size,
+                                          self.queue_owner_name)
 
         self.on_warn = on_warn
         self.on_delete = on_delete
 
-    def clear_deleted_queues(self, queues):
-        db_queues = Queue.query.all()
+        # State of every queue ((vhost, name) -> (messages, durable,
+        # limit_level)) as of the last cycle; only queues whose state
+        # differs are reconciled.
+        self.snapshot = {}
+        self.snapshot_resync_interval = snapshot_resync_interval
+        self._last_resync = 0
+        # Queues which couldn't be deleted, or which were left aside once
+        # the cycle's budget was spent, during the last cycle; they're
+        # reconciled on the next one even if they didn't change.
+        self._pending = set()
+        # If sharded, (vhost, name) of the queues of the other workers as of
+        # the last cycle, so that their records aren't taken for those of
+        # deleted queues (see clear_deleted_queues).
+        self._foreign = set()
 
-        # Filter queues that are in the database but no longer on RabbitMQ.
-        alive_queues_names = set(q['name'] for q in queues)
-        deleted_queues = set(q for q in db_queues if q.name
-                             not in alive_queues_names)
+        self.queue_page_size = queue_page_size
+        self.stream_queues = stream_queues
+        self.parallel_vhosts = parallel_vhosts
 
-        # Delete those queues.
-        for queue in deleted_queues:
-            logging.info("Queue '{0}' has been deleted.".format(queue))
-            db_session.delete(queue)
+        if scheduler is None:
+            scheduler = PollingScheduler(warn_queue_size, del_queue_size,
+                                         resolve=self.thresholds)
+        self.scheduler = scheduler
+
+    def clear_deleted_queues(self, queues=None):
+        """Deletes the records of the queues that are no longer on RabbitMQ
+        and refreshes the size of the others.
+
+        The work is done in the database with a staging table, so the cost
+        doesn't depend on the number of records.
+
+        :param queues: Listing of the queues on RabbitMQ.  If None, the
+                       snapshot taken by the last call to monitor_queues is
+                       used instead.
+        """
+        owns = None
+        if self.shard is not None:
+            owns = self.shard.owns
+        # The queues of the other workers are listed without their size,
+        # only to tell their records apart from those of deleted queues.
+        if queues is None:
+            rows = itertools.chain(
+                ((vhost, name, state[0], state[1])
+                 for (vhost, name), state in self.snapshot.iteritems()),
+                ((vhost, name, None, None) for vhost, name in self._foreign))
+        else:
+            rows = ((q.vhost, q.name, q.messages, q.durable)
+                    if owns is None or owns(q.name)
+                    else (q.vhost, q.name, None, None)
+                    for q in (QueueSnapshot.coerce(q) for q in queues))
+        try:
+            deleted = sync_queues(db_session, rows, owns)
+        except Exception:
+            db_session.rollback()
+            raise
+        db_session.commit()
+
+        for key in deleted:
+            logging.info("Queue '{1}' on vhost '{0}' has been "
+                         "deleted.".format(*key))
+            self.snapshot.pop(key, None)
+
+    def apply_events(self, events):
+        """Applies queue creation and deletion events (see events.QueueEvent)
+        to the database, in a single transaction, and to the snapshot, so
+        that the next cycle doesn't have to find these changes itself.
+        """
+        if self.shard is not None:
+            events = [event for event in events
+                      if self.shard.owns(event.name)]
+        if not events:
+            return
+        keys = set((event.vhost, event.name) for event in events)
+        db_queues = self.load_queues(keys)
+        owner_names = set(self.queue_owner_name(name) for vhost, name in keys
+                          if (vhost, name) not in db_queues)
+        owner_names.discard(None)
+        pulse_users = self.load_pulse_users(owner_names)
+
+        try:
+            for event in events:
+                key = (event.vhost, event.name)
+                if event.type == QUEUE_CREATED:
+                    queue_data = QueueSnapshot(event.name, event.vhost,
+                                               messages=0,
+                                               durable=event.durable)
+                    self.update_queue_information(queue_data, db_queues,
+                                                  pulse_users)
+                    self.snapshot[key] = (0, event.durable, None)
+                elif event.type == QUEUE_DELETED:
+                    queue = db_queues.pop(key, None)
+                    if queue is not None:
+                        logging.info("Queue '{1}' on vhost '{0}' has been "
+                                     "deleted.".format(*key))
+                        self._delete_queue_record(queue)
+                    self.snapshot.pop(key, None)
+                    self._pending.discard(key)
+        except Exception:
+            db_session.rollback()
+            raise
         db_session.commit()
 
-    def update_queue_information(self, queue_data):
-        if not 'messages' in queue_data:
+    def load_queues(self, keys=None):
+        """Loads queue records, along with their owner, and returns them in a
+        dict keyed by (vhost, queue name).  Every record is loaded in a
+        single query if keys is None; otherwise only the given ones are, in
+        batches of LOAD_BATCH_SIZE.
+        """
+        query = Queue.query.options(joinedload_all('owner.owner'))
+        if keys is None:
+            return dict((queue.key, queue) for queue in query.all())
+
+        # Composite IN clauses aren't portable; records are selected by name,
+        # which leads the (name, vhost) index, then filtered by vhost.
+        keys = set(keys)
+        db_queues = {}
+        for batch in _batches(set(name for vhost, name in keys),
+                              LOAD_BATCH_SIZE):
+            for queue in query.filter(Queue.name.in_(batch)):
+                if queue.key in keys:
+                    db_queues[queue.key] = queue
+        return db_queues
+
+    def load_pulse_users(self, usernames=None):
+        """Returns PulseUsers in a dict keyed by username; all of them if
+        usernames is None, otherwise only the given ones.
+        """
+        if usernames is None:
+            pulse_users = PulseUser.query.all()
+        else:
+            pulse_users = []
+            for batch in _batches(usernames, LOAD_BATCH_SIZE):
+                pulse_users.extend(PulseUser.query.filter(
+                    PulseUser.username.in_(batch)))
+        return dict((pulse_user.username, pulse_user)
+                    for pulse_user in pulse_users)
+
+    @staticmethod
+    def queue_owner_name(queue_name):
+        """Returns the name of the PulseUser owning a queue, as encoded in
+        the queue's name, or None for non-standard queue names.
+        """
+        m = re.match('queue/([^/]+)/', queue_name)
+        if m:
+            return m.group(1)
+        return None
+
+    def update_queue_information(self, queue_data, db_queues=None,
+                                 pulse_users=None):
+        """Updates (or creates) the record of a queue from its QueueSnapshot
+        (or the dict returned by the management API).  Changes are only
+        applied to the session; the caller is responsible for committing
+        them.
+
+        :param db_queues: Dict of known queue records keyed by (vhost,
+                          name), as returned by load_queues.  New records
+                          are added to it.
+        :param pulse_users: Dict of known PulseUsers keyed by username, as
+                            returned by load_pulse_users.  New users are
+                            added to it.
+        """
+        queue_data = QueueSnapshot.coerce(queue_data)
+        if queue_data.messages is None:
             # FIXME: We should do something here, probably delete the queue,
             # as it's in a weird state.  More investigation is required.
             # See bug 1066338.
             return None
 
-        q_size, q_name, q_durable = (queue_data['messages'],
-                                     queue_data['name'],
-                                     queue_data['durable'])
-        queue = Queue.query.filter(Queue.name == q_name).first()
+        q_size, q_name, q_durable = (queue_data.messages,
+                                     queue_data.name,
+                                     queue_data.durable)
+        if db_queues is None:
+            db_queues = {}
+            queue = Queue.query.filter(Queue.vhost == queue_data.vhost,
+                                       Queue.name == q_name).first()
+        else:
+            queue = db_queues.get(queue_data.key)
 
         # If the queue doesn't exist in the db, create it.
         if queue is None:
-            m = re.match('queue/([^/]+)/', q_name)
-            logging.info("New queue '{0}' encountered. "
-                         "Adding to the database.".format(q_name))
-            if m:
-                owner_name = m.group(1)
-                owner = PulseUser.query.filter(
-                    PulseUser.username == owner_name).first()
+            owner_name = self.queue_owner_name(q_name)
+            logging.info("New queue '{0}' encountered on vhost '{1}'. "
+                         "Adding to the database.".format(q_name,
+                                                          queue_data.vhost))
+            if owner_name:
+                if pulse_users is None:
+                    pulse_users = {}
+                    owner = PulseUser.query.filter(
+                        PulseUser.username == owner_name).first()
+                else:
+                    owner = pulse_users.get(owner_name)
 
                 # If the queue was created by a user that isn't in the
-                # pulseguardian database, skip the queue.
+                # pulseguardian database, create the user.
                 if owner is None:
                     logging.info(
                         "Queue '{0}' owner, {1}, isn't in the db. Creating "
                         "the user.".format(q_name, owner_name))
-                    owner = PulseUser.new_user(owner_name)
+                    owner = PulseUser(username=owner_name)
+                    db_session.add(owner)
+                pulse_users[owner_name] = owner
 
                 # Assign the user to the queue.
                 logging.info("Assigning queue '{0}' to user "
@@ -97,76 +376,424 @@ class PulseGuardian(object):
                 logging.warn("'{0}' is not a standard queue name.".format(
                     q_name))
                 owner = None
-            queue = Queue(name=q_name, owner=owner)
+            queue = Queue(vhost=queue_data.vhost, name=q_name, owner=owner)
+            db_session.add(queue)
+            db_queues[queue_data.key] = queue
 
         # Update the saved queue size.
         queue.size = q_size
         queue.durable = q_durable
-        db_session.add(queue)
-        db_session.commit()
         return queue
 
-    def monitor_queues(self, queues):
+    def _delete_queue_record(self, queue):
+        if queue in db_session.new:
+            # The record was created during this cycle and never flushed;
+            # detach it from its owner so that it isn't cascaded back in.
+            if queue.owner is not None:
+                queue.owner.queues.remove(queue)
+            db_session.expunge(queue)
+        else:
+            db_session.delete(queue)
+
+    def reset_snapshot(self):
+        """Forgets the state of the previous cycle so that every queue is
+        reconciled against the database on the next one.
+        """
+        self.snapshot = {}
+        self._foreign = set()
+
+    def diff_snapshot(self, queues, vhost=None):
+        """Compares a listing of the queues on RabbitMQ with the snapshot of
+        the previous cycle.
+
+        Returns a tuple (changed, vanished, live): the data of queues that
+        are new or whose size, durability or limit level changed, the
+        (vhost, name) of the queues that are no longer on RabbitMQ and the
+        new state of every queue.  If vhost is given, the listing only
+        covers that vhost and the queues of the others aren't considered
+        vanished.
+        """
+        live = {}
+        changed = []
         for queue_data in queues:
-            # Updating the queue's information in the database (owner, size).
-            queue = self.update_queue_information(queue_data)
-            if not queue:
-                continue
+            queue_data = QueueSnapshot.coerce(queue_data)
+            key = queue_data.key
+            # Resource usages vary all the time; only whether they're over
+            # their limits is part of the state.
+            state = (queue_data.messages, queue_data.durable,
+                     self.limit_level(queue_data))
+            live[key] = state
+            if self.snapshot.get(key) != state or key in self._pending:
+                changed.append(queue_data)
+        vanished = [key for key in self.snapshot if key not in live and
+                    (vhost is None or key[0] == vhost)]
+        return changed, vanished, live
+
+    def begin_cycle(self):
+        """Refreshes the threshold policies and, if sharded, the shard's
+        membership, and resets the snapshot if either changed or if it's
+        due for a resync.  Returns True if the snapshot was reset.
+
+        This must only be called before any queue of the cycle is
+        monitored: the snapshot of a partly monitored cycle would be
+        missing the queues monitored so far.
+        """
+        reset = False
+        if self.policies.refresh():
+            # Queues that didn't change may be subject to new thresholds.
+            reset = True
+        if self.shard is not None and self.shard.heartbeat():
+            # Queues moved between shards; those that left this one
+            # mustn't be taken for deleted ones.
+            reset = True
+        if time.time() - self._last_resync > self.snapshot_resync_interval:
+            self._last_resync = time.time()
+            reset = True
+        if reset:
+            self.reset_snapshot()
+        return reset
+
+    def monitor_queues(self, queues):
+        """Reconciles the database with a listing of the queues on RabbitMQ
+        and enforces the warning and deletion thresholds.
 
-            # If a queue is over the deletion size, regardless of it having an
-            # owner or not, delete it.
-            if queue.size > self.del_queue_size:
-                logging.warning("Queue '{0}' deleted. Queue size = {1}; "
-                               "del_queue_size = {2}".format(
-                    queue.name, queue.size, self.del_queue_size))
-                if queue.owner and queue.owner.owner:
-                    self.deletion_email(queue.owner.owner, queue_data)
-                if self.on_delete:
-                    self.on_delete(queue.name)
-                self.api.delete_queue(vhost=queue_data['vhost'],
-                                      queue=queue.name)
-                db_session.delete(queue)
-                db_session.commit()
+        Only the queues that changed since the previous cycle are looked at.
+        Their records are loaded up front, every change made during the
+        cycle is committed in a single transaction and the queues over the
+        deletion threshold are deleted concurrently.  Queues are handled in
+        order of priority (see prioritize()); once cycle_budget seconds have
+        elapsed, the queues which only need bookkeeping are left for the
+        next cycle.  If sharded, the queues of the other workers are
+        ignored.  Returns the (vhost, name) of the deleted queues.
+        """
+        self.begin_cycle()
+        return self._monitor(queues)
+
+    def _monitor(self, queues, vhost=None):
+        """Does the work of monitor_queues, within a cycle started by
+        begin_cycle().  If vhost is given, the listing only covers that
+        vhost and the queues of the others are left as they are.
+        """
+        deadline = None
+        if self.cycle_budget:
+            deadline = time.time() + self.cycle_budget
+        if self.shard is not None:
+            queues = self._shard_queues(queues, vhost)
+
+        changed, vanished, live = self.diff_snapshot(
+            self.scheduler.observe(queues, vhost), vhost)
+        deleted, pending = [], []
+        if changed or vanished:
+            deleted, pending = self._reconcile(changed, vanished, deadline)
+            for key in deleted:
+                del live[key]
+        if vhost is not None:
+            # Keep the state of the other vhosts.
+            pending.extend(key for key in self._pending if key[0] != vhost)
+            for key, state in self.snapshot.iteritems():
+                if key[0] != vhost:
+                    live[key] = state
+        self._pending = set(pending)
+        self.snapshot = live
+        return deleted
+
+    def monitor_vhosts(self, async_api):
+        """Lists the queues of each vhost separately on async_api's threads
+        and monitors each vhost as soon as its listing arrives (see
+        monitor_queues), so that a large vhost doesn't hold up enforcement
+        on the others.
+
+        The queues of a vhost whose listing failed are left as they are
+        until the next cycle.  The records of the queues that are gone are
+        only cleared once every vhost was listed, and not after the
+        snapshot was reset (see begin_cycle), in case a vhost missed the
+        cycle.  Returns the (vhost, name) of the deleted queues.
+        """
+        vhosts = self.api.vhosts()
+        # The snapshot is only reset before any vhost is monitored, so that
+        # it doesn't lose the vhosts monitored earlier in the cycle.
+        complete = not self.begin_cycle()
+        deleted = []
+        for vhost, queues, error in async_api.vhost_snapshots(
+                vhosts, page_size=self.queue_page_size,
+                stream=self.stream_queues):
+            if error is not None:
+                logging.error("Couldn't list the queues of vhost '{0}': "
+                              "{1}".format(vhost, error))
+                complete = False
                 continue
+            deleted.extend(self._monitor(queues, vhost))
+        # The queues of the vhosts that were deleted are gone too.
+        for vhost in set(vhost for vhost, name in self.snapshot) - set(vhosts):
+            deleted.extend(self._monitor([], vhost))
+        if complete:
+            self.clear_deleted_queues()
+        return deleted
+
+    def _shard_queues(self, queues, vhost=None):
+        """Yields the queues of this worker's shard from a listing and
+        keeps the (vhost, name) of the others in _foreign.  If vhost is
+        given, the listing only covers that vhost.
+        """
+        foreign = set()
+        if vhost is not None:
+            foreign.update(key for key in self._foreign if key[0] != vhost)
+        for queue_data in queues:
+            queue_data = QueueSnapshot.coerce(queue_data)
+            if self.shard.owns(queue_data.name):
+                yield queue_data
+            else:
+                foreign.add(queue_data.key)
+        self._foreign = foreign
+
+    def prioritize(self, changed, db_queues):
+        """Evaluates the thresholds of the changed queues all at once (see
+        ThresholdEvaluator) and returns (priority, QueueSnapshot) pairs in
+        the order the queues must be handled: PRIORITY_DELETE, closest to
+        deletion first, then PRIORITY_WARN, then PRIORITY_BOOKKEEPING.
+        """
+        records = [db_queues.get(queue_data.key) for queue_data in changed]
+        warn_sizes = del_sizes = None
+        if self.policies.overridden:
+            thresholds = [self.thresholds(queue_data.name)
+                          for queue_data in changed]
+            warn_sizes = [warn_size for warn_size, del_size in thresholds]
+            del_sizes = [del_size for warn_size, del_size in thresholds]
+        evaluation = self.evaluator.evaluate(
+            [queue_data.messages for queue_data in changed],
+            [self.scheduler.growth_rate(queue_data.name, queue_data.vhost)
+             for queue_data in changed],
+            [queue is not None and bool(queue.warned) for queue in records],
+            warn_sizes=warn_sizes, del_sizes=del_sizes,
+            usages=dict((metric, [getattr(queue_data, metric)
+                                  for queue_data in changed])
+                        for metric in self.limits))
+
+        prioritized = [(PRIORITY_DELETE, changed[i])
+                       for i in evaluation.delete]
+        prioritized.extend((PRIORITY_WARN, changed[i])
+                           for i in evaluation.warn + evaluation.normal)
+        prioritized.extend((PRIORITY_BOOKKEEPING, changed[i])
+                           for i in evaluation.rest)
+        return prioritized
+
+    def _reconcile(self, changed, vanished, deadline=None):
+        """Applies the changes found by diff_snapshot to the database in a
+        single transaction.  Returns the (vhost, name) of the queues deleted
+        by the guardian and of those left for the next cycle: the ones it
+        failed to delete and the ones whose bookkeeping was deferred because
+        deadline was past.
+        """
+        db_queues = self.load_queues([q.key for q in changed] + vanished)
+        owner_names = set(self.queue_owner_name(q.name) for q in changed
+                          if q.key not in db_queues)
+        owner_names.discard(None)
+        pulse_users = self.load_pulse_users(owner_names)
+
+        deleted, pending, deferred = [], [], []
+        try:
+            overgrown = []
+            for priority, queue_data in self.prioritize(changed, db_queues):
+                # Delete the queues as soon as they've all been found,
+                # before dealing with the others.
+                if priority != PRIORITY_DELETE and overgrown:
+                    self._delete_queues(overgrown, db_queues, deleted,
+                                        pending)
+                    overgrown = []
+                if priority == PRIORITY_BOOKKEEPING:
+                    # The thresholds don't call for any action; only the
+                    # record needs updating.
+                    if deadline is not None and time.time() > deadline:
+                        deferred.append(queue_data.key)
+                    else:
+                        self.update_queue_information(queue_data, db_queues,
+                                                      pulse_users)
+                    continue
+
+                queue = self._monitor_queue(queue_data, db_queues,
+                                            pulse_users)
+                if queue is not None:
+                    overgrown.append((queue, queue_data))
+            if overgrown:
+                self._delete_queues(overgrown, db_queues, deleted, pending)
+
+            if deferred:
+                logging.info("Cycle budget spent; deferring the bookkeeping "
+                             "of {0} queues to the next cycle.".format(
+                                 len(deferred)))
+                pending.extend(deferred)
+
+            for key in vanished:
+                queue = db_queues.get(key)
+                if queue is not None:
+                    logging.info("Queue '{1}' on vhost '{0}' has been "
+                                 "deleted.".format(*key))
+                    db_session.delete(queue)
+        except Exception:
+            db_session.rollback()
+            raise
+        db_session.commit()
+        return deleted, pending
 
-            if queue.owner is None or queue.owner.owner is None:
+    def _delete_queues(self, overgrown, db_queues, deleted, undeleted):
+        """Deletes queues from RabbitMQ, concurrently, then notifies their
+        owners and deletes their records.
+
+        :param overgrown: List of (record, QueueSnapshot) pairs.
+        :param deleted: List the (vhost, name) of the deleted queues are
+                        added to.
+        :param undeleted: List the (vhost, name) of the queues that couldn't
+                          be deleted are added to.
+        """
+        if self.election is not None and not self.election.campaign():
+            # The cycle outlasted the leadership and a standby may be
+            # dealing with these queues already.
+            logging.warning("Lost the leadership; not deleting {0} "
+                            "queues.".format(len(overgrown)))
+            undeleted.extend(queue.key for queue, queue_data in overgrown)
+            return
+        results = self.api.delete_queues(
+            (queue_data.vhost, queue_data.name)
+            for queue, queue_data in overgrown)
+
+        for (queue, queue_data), (item, error) in zip(overgrown, results):
+            if error is not None:
+                logging.error("Couldn't delete queue '{0}': {1}".format(
+                    queue.name, error))
+                undeleted.append(queue.key)
                 continue
 
-            if queue.size > self.warn_queue_size and not queue.warned:
-                logging.warning("Warning queue '{0}' owner. Queue size = "
-                                "{1}; warn_queue_size = {2}".format(
-                                    queue.name, queue.size,
-                                    self.warn_queue_size))
-                queue.warned = True
-                if self.on_warn:
-                    self.on_warn(queue.name)
-                self.warning_email(queue.owner.owner, queue_data)
-            elif queue.size <= self.warn_queue_size and queue.warned:
-                # A previously warned queue got out of the warning threshold;
-                # its owner should not be warned again.
-                logging.warning("Queue '{0}' was in warning zone but is OK "
-                               "now".format(queue.name, queue.size,
-                                            self.del_queue_size))
-                queue.warned = False
-                self.back_to_normal_email(queue.owner.owner, queue_data)
-
-            # Commit any changes to the queue.
-            db_session.add(queue)
-            db_session.commit()
+            logging.warning("Queue '{0}' deleted. Queue size = {1}; "
+                            "del_queue_size = {2}".format(
+                                queue.name, queue.size,
+                                self.thresholds(queue.name)[1]))
+            for metric, usage, limit in self.exceeded_limits(queue_data,
+                                                             DELETE):
+                logging.warning("Queue '{0}' {1} = {2}; limit = {3}".format(
+                    queue.name, metric, usage, limit))
+            if queue.owner and queue.owner.owner:
+                self.deletion_email(queue.owner.owner, queue_data)
+            if self.on_delete:
+                self.on_delete(queue.name)
+            self._delete_queue_record(queue)
+            del db_queues[queue.key]
+            deleted.append(queue.key)
+
+    def thresholds(self, queue_name):
+        """Returns the (warn_queue_size, del_queue_size) thresholds of a
+        queue, as set by the policies.
+        """
+        return self.policies.resolve(queue_name)
+
+    def exceeded_limits(self, queue_data, level):
+        """Returns the (metric, usage, limit) of the resource usages of a
+        queue over their WARN or DELETE limit.
+        """
+        exceeded = []
+        for metric, thresholds in self.limits.iteritems():
+            usage, limit = getattr(queue_data, metric), thresholds[level]
+            if limit and usage is not None and usage > limit:
+                exceeded.append((metric, usage, limit))
+        return exceeded
+
+    def limit_level(self, queue_data):
+        """Returns DELETE if a resource usage of a queue is over its
+        deletion limit, WARN if one is over its warning limit and None
+        otherwise.
+        """
+        if not self.limits:
+            return None
+        if self.exceeded_limits(queue_data, DELETE):
+            return DELETE
+        if self.exceeded_limits(queue_data, WARN):
+            return WARN
+        return None
+
+    def time_to_deletion(self, queue_data):
+        """Returns the number of seconds before a queue reaches the deletion
+        threshold at its current growth rate: 0 if it's already over it,
+        infinity if it isn't growing.
+        """
+        if queue_data.messages is None:
+            return float('inf')
+        del_queue_size = self.thresholds(queue_data.name)[1]
+        if queue_data.messages > del_queue_size:
+            return 0.0
+        if self.limits and self.exceeded_limits(queue_data, DELETE):
+            return 0.0
+        rate = self.scheduler.growth_rate(queue_data.name, queue_data.vhost)
+        if rate <= 0:
+            return float('inf')
+        return (del_queue_size - queue_data.messages) / rate
+
+    def _monitor_queue(self, queue_data, db_queues, pulse_users):
+        """Updates a queue's record and applies the warning threshold to
+        it.  Returns the record if the queue is over the deletion threshold,
+        or projected to reach it within del_horizon seconds, and must be
+        deleted; None otherwise.
+        """
+        # Updating the queue's information in the database (owner, size).
+        queue = self.update_queue_information(queue_data, db_queues,
+                                              pulse_users)
+        if not queue:
+            return None
+        warn_queue_size, del_queue_size = self.thresholds(queue.name)
+
+        # If a queue is over the deletion size or uses too much memory,
+        # regardless of it having an owner or not, it's deleted (along with
+        # the others, at the end of the cycle).
+        if (queue.size > del_queue_size or
+                self.exceeded_limits(queue_data, DELETE)):
+            return queue
+
+        eta = self.time_to_deletion(queue_data)
+        if eta < self.del_horizon:
+            logging.warning("Queue '{0}' is projected to exceed "
+                            "del_queue_size in {1:.0f}s.".format(
+                                queue.name, eta))
+            return queue
+
+        if queue.owner is None or queue.owner.owner is None:
+            return None
+
+        overgrowing = (queue.size > warn_queue_size or
+                       eta < self.warn_horizon or
+                       bool(self.exceeded_limits(queue_data, WARN)))
+        if overgrowing and not queue.warned:
+            logging.warning("Warning queue '{0}' owner. Queue size = "
+                            "{1}; warn_queue_size = {2}".format(
+                                queue.name, queue.size, warn_queue_size))
+            if eta < self.warn_horizon:
+                logging.warning("Queue '{0}' is projected to exceed "
+                                "del_queue_size in {1:.0f}s.".format(
+                                    queue.name, eta))
+            queue.warned = True
+            if self.on_warn:
+                self.on_warn(queue.name)
+            self.warning_email(queue.owner.owner, queue_data)
+        elif not overgrowing and queue.warned:
+            # A previously warned queue got out of the warning threshold;
+            # its owner should not be warned again.
+            logging.warning("Queue '{0}' was in warning zone but is OK "
+                           "now".format(queue.name))
+            queue.warned = False
+            self.back_to_normal_email(queue.owner.owner, queue_data)
+        return None
 
     def _exchange_from_queue(self, queue_data):
-        exchange = 'could not be determined'
-        detailed_data = self.api.queue(vhost=queue_data['vhost'],
-                                       queue=queue_data['name'])
-        if detailed_data['incoming']:
-            exchange = detailed_data['incoming'][0]['exchange']['name']
+        exchange = self.exchange_resolver.exchange(queue_data.vhost,
+                                                   queue_data.name)
+        if exchange is None:
+            return 'could not be determined'
         return exchange
 
     def warning_email(self, user, queue_data):
+        if not self.emails or user.email is None:
+            return
         exchange = self._exchange_from_queue(queue_data)
 
         subject = 'Pulse warning: queue "{0}" is overgrowing'.format(
-            queue_data['name'])
+            queue_data.name)
         body = '''Warning: your queue "{0}" on exchange "{1}" is
 overgrowing ({2} ready messages, {3} total messages).
 
@@ -174,79 +801,314 @@ The queue will be automatically deleted when it exceeds {4} messages.
 
 Make sure your clients are running correctly and are cleaning up unused
 durable queues.
-'''.format(queue_data['name'], exchange, queue_data['messages_ready'],
-           queue_data['messages'], self.del_queue_size)
+'''.format(queue_data.name, exchange, queue_data.messages_ready,
+           queue_data.messages, self.thresholds(queue_data.name)[1])
 
-        if self.emails and user.email is not None:
-            self._sendemail(subject=subject, body=body,
-                           user=user, queue_data=queue_data)
+        self._sendemail(subject=subject, body=body,
+                        user=user, queue_data=queue_data)
 
     def deletion_email(self, user, queue_data):
+        if not self.emails or user.email is None:
+            return
         exchange = self._exchange_from_queue(queue_data)
 
         subject = 'Pulse warning: queue "{0}" has been deleted'.format(
-            queue_data['name'])
+            queue_data.name)
+        del_queue_size = self.thresholds(queue_data.name)[1]
+        exceeded = self.exceeded_limits(queue_data, DELETE)
+        if queue_data.messages > del_queue_size:
+            reason = 'after exceeding the maximum number of unread messages'
+        elif exceeded:
+            metric, usage, limit = exceeded[0]
+            reason = 'after its {0} ({1} bytes) exceeded {2} bytes'.format(
+                RESOURCE_LABELS[metric], usage, limit)
+        else:
+            reason = ('as it was growing fast enough to soon exceed the '
+                      'maximum number of unread messages')
         body = '''Your queue "{0}" on exchange "{1}" has been
-deleted after exceeding the maximum number of unread messages.  Upon deletion
-there were {2} messages in the queue, out of a maximum {3} messages.
+deleted {4}.  Upon deletion there were {2} messages in the queue, out of a
+maximum {3} messages.
 
 Make sure your clients are running correctly and are cleaning up unused
 durable queues.
-'''.format(queue_data['name'], exchange, queue_data['messages'],
-           self.del_queue_size)
+'''.format(queue_data.name, exchange, queue_data.messages,
+           del_queue_size, reason)
 
-        if self.emails and user.email is not None:
-            sendemail(subject=subject, from_addr=config.email_from,
-                      to_addrs=[user.email.address], username=config.email_account,
-                      password=config.email_password, text_data=body,
-                      server=config.email_smtp_server,
-                      port=config.email_smtp_port,
-                      use_ssl=config.email_ssl)
+        self._sendemail(subject=subject, body=body, user=user)
 
     def back_to_normal_email(self, user, queue_data):
+        if not self.emails or user.email is None:
+            return
         exchange = self._exchange_from_queue(queue_data)
 
         subject = 'Pulse warning: queue "{0}" is back to normal'.format(
-            queue_data['name'])
+            queue_data.name)
         body = '''Your queue "{0}" on exchange "{1}" is
 now back to normal ({2} ready messages, {3} total messages).
-'''.format(queue_data['name'], exchange, queue_data['messages_ready'],
-           queue_data['messages'], self.del_queue_size)
-
-        if self.emails and user.email is not None:
-            self._sendemail(subject=subject, body=body,
-                           user=user, queue_data=queue_data)
-
-    def _sendemail(self, subject, body, user, queue_data):
-        to_addrs = []
-        to_addrs.append(user.email.address)
-        to_addrs.append(Queue.get_notifications(queue_data['name']))
-        sendemail(subject=subject, from_addr=config.email_from,
-                  to_addrs=to_addrs, username=config.email_account,
-                  password=config.email_password, text_data=body,
-                  server=config.email_smtp_server,
-                  port=config.email_smtp_port,
-                  use_ssl=config.email_ssl)
+'''.format(queue_data.name, exchange, queue_data.messages_ready,
+           queue_data.messages)
+
+        self._sendemail(subject=subject, body=body,
+                        user=user, queue_data=queue_data)
+
+    def _sendemail(self, subject, body, user, queue_data=None):
+        """Queues an email to a queue's owner and, if queue_data is given,
+        to the addresses registered for notifications on the queue.  The
+        recipients are resolved here since the notifier's workers can't use
+        the database session.
+        """
+        to_addrs = [user.email.address]
+        if queue_data is not None:
+            to_addrs.extend(email.address for email in
+                            Queue.get_notifications(queue_data.name,
+                                                    queue_data.vhost))
+        self.notifier.notify(subject, body, to_addrs)
+
+    def list_queues(self):
+        """Returns an iterator over snapshots of the queues on RabbitMQ.
+        Depending on the configuration, they're fetched all at once, page
+        by page or streamed.
+        """
+        return self.api.queue_snapshots(page_size=self.queue_page_size,
+                                        stream=self.stream_queues)
+
+    def await_leadership(self):
+        """Returns once this guardian is the leader of the election,
+        renewing its leadership if it already is.  Meanwhile, a standby
+        campaigns every election.retry_interval seconds without polling
+        RabbitMQ.
+        """
+        if self.election is None:
+            return
+        was_leader = self.election.is_leader
+        while not self.election.campaign():
+            if was_leader:
+                logging.warning("Lost the leadership; standing by.")
+                was_leader = False
+            time.sleep(self.election.retry_interval)
+        if not was_leader:
+            logging.info("Became the leader.")
+            # The queues changed while another guardian was in charge.
+            self.reset_snapshot()
+
+    def is_leader(self):
+        return self.election is None or self.election.is_leader
+
+    def shutdown(self):
+        """Delivers the notifications of the last cycle and, if sharded,
+        hands this guardian's queues over to the other workers; if elected,
+        lets a standby take over.
+        """
+        if self.notifier is not None:
+            self.notifier.shutdown()
+        if self.shard is not None:
+            self.shard.leave()
+        if self.election is not None:
+            self.election.resign()
 
     def guard(self):
         logging.info("PulseGuardian started")
-        while True:
-            queues = self.api.queues()
-            if queues:
-                self.monitor_queues(queues)
-            self.clear_deleted_queues(queues)
-            time.sleep(config.polling_interval)
+        async_api = None
+        if self.parallel_vhosts:
+            async_api = AsyncPulseManagementAPI(self.api)
+        try:
+            while True:
+                self.await_leadership()
+                try:
+                    if async_api is not None:
+                        self.monitor_vhosts(async_api)
+                    else:
+                        queues = self.list_queues()
+                        # Never clear the queues if the listing itself
+                        # failed.
+                        if queues is not None:
+                            self.monitor_queues(queues)
+                            # The listing may have been consumed already;
+                            # the snapshot holds the same information.
+                            self.clear_deleted_queues()
+                except self.api.exception:
+                    logging.exception("The RabbitMQ management API is "
+                                      "unavailable; skipping this cycle.")
+                if self.notifier is not None:
+                    logging.debug("Notifications: {0}".format(
+                        self.notifier.metrics()))
+                time.sleep(self.scheduler.next_interval())
+        finally:
+            if async_api is not None:
+                async_api.close()
+            self.shutdown()
+
+    def guard_pipelined(self, buffer_size=config.pipeline_buffer_size):
+        """Like guard(), but the queues are listed periodically by a
+        background thread while the previous listing is being processed.
+        Listings that couldn't be processed before newer ones arrived are
+        dropped (see Handoff).
+        """
+        logging.info("PulseGuardian started (pipelined)")
+        handoff = Handoff(buffer_size)
+        fetcher = SnapshotFetcher(self.list_queues, handoff,
+                                  self.scheduler.interval,
+                                  self.api.exception, active=self.is_leader)
+        fetcher.start()
+        # Queue key -> time of its deletion by the guardian, to ignore
+        # the queue in listings fetched before it was deleted.
+        recently_deleted = {}
+        try:
+            while True:
+                self.await_leadership()
+                item = handoff.get(self.scheduler.interval)
+                if item is None:
+                    continue
+                fetched_at, queues = item
+                queues = [q for q in queues
+                          if recently_deleted.get(q.key, 0) < fetched_at]
+                for key, deleted_at in recently_deleted.items():
+                    if deleted_at < fetched_at:
+                        del recently_deleted[key]
+
+                try:
+                    for key in self.monitor_queues(queues):
+                        recently_deleted[key] = time.time()
+                    self.clear_deleted_queues()
+                except self.api.exception:
+                    logging.exception("The RabbitMQ management API is "
+                                      "unavailable; skipping this cycle.")
+                fetcher.interval = self.scheduler.next_interval()
+                logging.debug("Listing processed {0:.1f}s after being "
+                              "fetched; {1} listings dropped so far.".format(
+                                  time.time() - fetched_at, handoff.dropped))
+                if self.notifier is not None:
+                    logging.debug("Notifications: {0}".format(
+                        self.notifier.metrics()))
+        finally:
+            fetcher.stop()
+            self.shutdown()
+
+    def run_cycle_async(self, async_api):
+        """Runs a guardian cycle, fetching the queue listing and the
+        bindings (used to name the queues' exchanges in emails) at the same
+        time on async_api's threads.  With parallel_vhosts, the vhosts are
+        listed and monitored concurrently (see monitor_vhosts).
+        """
+        listing = None
+        if not self.parallel_vhosts:
+            listing = async_api.queue_snapshots(
+                page_size=self.queue_page_size, stream=self.stream_queues)
+        prefetch = None
+        if self.emails:
+            prefetch = async_api.submit(self.exchange_resolver.prefetch)
+        try:
+            if prefetch is not None:
+                wait(prefetch)
+            if listing is None:
+                self.monitor_vhosts(async_api)
+            else:
+                self.monitor_queues(wait(listing))
+                self.clear_deleted_queues()
+        except self.api.exception:
+            logging.exception("The RabbitMQ management API is "
+                              "unavailable; skipping this cycle.")
+
+    def guard_async(self):
+        """Like guard(), but the requests of each cycle are made
+        concurrently (see run_cycle_async) and the polling interval is
+        counted from the start of a cycle rather than from its end.
+        """
+        logging.info("PulseGuardian started (asynchronous)")
+        async_api = AsyncPulseManagementAPI(self.api)
+        try:
+            while True:
+                self.await_leadership()
+                started = time.time()
+                self.run_cycle_async(async_api)
+                if self.notifier is not None:
+                    logging.debug("Notifications: {0}".format(
+                        self.notifier.metrics()))
+                interval = self.scheduler.next_interval()
+                elapsed = time.time() - started
+                if elapsed > interval:
+                    logging.warning("Cycle took {0:.1f}s, longer than the "
+                                    "polling interval.".format(elapsed))
+                time.sleep(max(0, interval - elapsed))
+        finally:
+            async_api.close()
+            self.shutdown()
+
+    def guard_events(self, source,
+                     repair_interval=config.event_repair_interval):
+        """Like guard(), but new and deleted queues are tracked as they come
+        and go from the events of source (see events.AmqpEventSource).  The
+        queues are still listed at every polling interval, for their sizes,
+        but the records of the queues missed by the snapshot are only
+        reconciled with a listing (see clear_deleted_queues) every
+        repair_interval seconds, or at once if events may have been lost.
+        """
+        logging.info("PulseGuardian started (event-driven)")
+        last_repair = 0
+        try:
+            while True:
+                self.await_leadership()
+                try:
+                    queues = self.list_queues()
+                    if queues is not None:
+                        self.monitor_queues(queues)
+                        if time.time() - last_repair > repair_interval:
+                            self.clear_deleted_queues()
+                            last_repair = time.time()
+                except self.api.exception:
+                    logging.exception("The RabbitMQ management API is "
+                                      "unavailable; skipping this cycle.")
+                if self.notifier is not None:
+                    logging.debug("Notifications: {0}".format(
+                        self.notifier.metrics()))
+
+                next_poll = time.time() + self.scheduler.next_interval()
+                while time.time() < next_poll:
+                    try:
+                        self.apply_events(
+                            source.drain(next_poll - time.time()))
+                    except source.exception:
+                        logging.exception("Queue events are unavailable; "
+                                          "repairing the records at the "
+                                          "next cycle.")
+                        last_repair = 0
+                        time.sleep(max(0, next_poll - time.time()))
+        finally:
+            source.close()
+            self.shutdown()
 
 
 if __name__ == '__main__':
     # Add StreamHandler for development purposes
     logging.getLogger().addHandler(logging.StreamHandler())
 
+    # Exit cleanly (flushing pending notifications) when asked to stop.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    # The event and pipelined loops list every vhost at once.
+    if config.parallel_vhosts and (config.event_tracking or
+                                   config.pipelined_guard):
+        sys.exit("PARALLEL_VHOSTS can't be combined with EVENT_TRACKING or "
+                 "PIPELINED_GUARD.")
+
     # Initialize the database if necessary.
     init_db()
 
     api = PulseManagementAPI(management_url=config.rabbit_management_url,
                              user=config.rabbit_user,
                              password=config.rabbit_password)
-    pulse_guardian = PulseGuardian(api)
-    pulse_guardian.guard()
+    shard = None
+    if config.sharded_guard:
+        shard = ShardCoordinator()
+    election = None
+    if config.leader_election:
+        election = create_election()
+    pulse_guardian = PulseGuardian(api, shard=shard, election=election)
+    if config.event_tracking:
+        pulse_guardian.guard_events(AmqpEventSource())
+    elif config.pipelined_guard:
+        pulse_guardian.guard_pipelined()
+    elif config.async_guard:
+        pulse_guardian.guard_async()
+    else:
+        pulse_guardian.guard()
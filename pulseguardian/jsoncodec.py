@@ -0,0 +1,132 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""JSON decoding of management API responses.
+
+Whole responses are decoded with the fastest codec installed (ujson, then
+simplejson, then the standard library).  Large arrays can also be decoded
+incrementally, one element at a time, so that the whole document never has
+to be held in memory: with ijson if it's installed, otherwise with the
+standard library's decoder applied to each element in turn.
+"""
+
+import codecs
+import json
+from decimal import Decimal
+
+try:
+    import ujson as _codec
+except ImportError:
+    try:
+        import simplejson as _codec
+    except ImportError:
+        _codec = json
+
+_ijson = None
+for _backend in ('ijson.backends.yajl2_cffi', 'ijson.backends.yajl2',
+                 'ijson'):
+    try:
+        _ijson = __import__(_backend, fromlist=['items'])
+        break
+    except Exception:
+        # Missing, or broken (e.g. ijson 3, which needs Python 3): the
+        # standard library's decoder is used instead.
+        pass
+
+CHUNK_SIZE = 64 * 1024
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = u' \t\n\r'
+_DELIMITERS = _WHITESPACE + u',]'
+
+
+def loads(data):
+    return _codec.loads(data)
+
+
+def iter_array(chunks):
+    """Yields the elements of a JSON array one at a time.
+
+    :param chunks: Iterable of unicode strings which, concatenated, form a
+                   JSON array.
+    :raises ValueError: If the array is malformed or truncated.
+    """
+    chunks = iter(chunks)
+    buf, pos = u'', 0
+    exhausted = False
+    state = 'start'
+
+    while True:
+        while pos < len(buf) and buf[pos] in _WHITESPACE:
+            pos += 1
+
+        if pos < len(buf) and state == 'value':
+            try:
+                item, end = _decoder.raw_decode(buf, pos)
+            except ValueError:
+                end = None
+            # A value that isn't followed by a delimiter yet may be truncated
+            # (e.g. "1." out of "1.5"), so it's only trusted once one is.
+            if end is not None and (exhausted or (
+                    end < len(buf) and buf[end] in _DELIMITERS)):
+                pos = end
+                state = 'separator'
+                yield item
+                continue
+        elif pos < len(buf):
+            c = buf[pos]
+            if state == 'start':
+                if c != u'[':
+                    raise ValueError('Expected a JSON array.')
+                state = 'first'
+            elif c == u']':
+                return
+            elif state == 'first':
+                state = 'value'
+                continue
+            elif c == u',':
+                state = 'value'
+            else:
+                raise ValueError(
+                    "Unexpected '{0}' in JSON array.".format(c))
+            pos += 1
+            continue
+
+        if exhausted:
+            raise ValueError('Truncated JSON array.')
+        try:
+            buf, pos = buf[pos:] + next(chunks), 0
+        except StopIteration:
+            exhausted = True
+
+
+def _floats(value):
+    """Returns value with the Decimals that ijson decodes non-integer
+    numbers as, however deeply nested, replaced by floats like the other
+    codecs return.
+    """
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, dict):
+        return dict((key, _floats(item)) for key, item in value.iteritems())
+    if isinstance(value, list):
+        return [_floats(item) for item in value]
+    return value
+
+
+def iter_response_array(response):
+    """Yields the elements of a JSON array from a streamed requests response
+    one at a time.
+    """
+    if _ijson is not None:
+        response.raw.decode_content = True
+        for item in _ijson.items(response.raw, 'item'):
+            yield _floats(item)
+        return
+
+    decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')()
+    chunks = (decoder.decode(chunk)
+              for chunk in response.iter_content(CHUNK_SIZE))
+    for item in iter_array(chunks):
+        yield item
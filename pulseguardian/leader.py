@@ -0,0 +1,170 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Election of the single active guardian among redundant instances, through
+the database.
+
+An election's campaign() method tries to make this instance the leader, or
+to keep it the leader, and returns whether it is; resign() gives up the
+leadership.  Standbys campaign every retry_interval seconds, so they take
+over within that time of the leadership being released.
+"""
+
+import logging
+import os
+import socket
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, func, or_, select, text
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+
+from pulseguardian import config
+from pulseguardian.model.base import engine
+from pulseguardian.model.models import GuardianLease
+
+# Name of the lease held by the leader.
+LEADER_LEASE = 'leader'
+
+
+def _default_holder():
+    return '{0}:{1}'.format(socket.gethostname(), os.getpid())
+
+
+class AdvisoryLockElection(object):
+    """Leadership held as a PostgreSQL session-level advisory lock, on a
+    connection dedicated to it.  The lock is released by the server as soon
+    as the leader's connection is closed, e.g. when it exits or dies.
+
+    :param engine: SQLAlchemy engine of a PostgreSQL database.
+    :param lock_id: Key of the advisory lock, shared by the guardians.
+    :param retry_interval: Seconds between two campaigns of a standby.
+    """
+
+    def __init__(self, engine=engine, lock_id=config.leader_lock_id,
+                 retry_interval=config.leader_retry_interval):
+        self.engine = engine
+        self.lock_id = lock_id
+        self.retry_interval = retry_interval
+        self.connection = None
+        self.is_leader = False
+
+    def campaign(self):
+        try:
+            if self.connection is None:
+                # Don't leave the connection idle in a transaction.
+                self.connection = self.engine.connect().execution_options(
+                    autocommit=True)
+            if self.is_leader:
+                # The lock lives as long as the connection does.
+                self.connection.execute(text('SELECT 1'))
+            else:
+                self.is_leader = bool(self.connection.execute(
+                    text('SELECT pg_try_advisory_lock(:lock_id)'),
+                    lock_id=self.lock_id).scalar())
+        except SQLAlchemyError:
+            logging.exception("Couldn't check the leadership lock.")
+            self._disconnect()
+        return self.is_leader
+
+    def _disconnect(self):
+        self.is_leader = False
+        if self.connection is not None:
+            try:
+                self.connection.invalidate()
+            except SQLAlchemyError:
+                pass
+            self.connection = None
+
+    def resign(self):
+        if self.is_leader:
+            try:
+                self.connection.execute(
+                    text('SELECT pg_advisory_unlock(:lock_id)'),
+                    lock_id=self.lock_id)
+            except SQLAlchemyError:
+                pass
+        self._disconnect()
+
+
+class LeaseElection(object):
+    """Leadership held as a lease in the guardian_leases table, renewed at
+    every campaign; it passes to a standby once it expires.  This works
+    with any database, but the leader must campaign more often than every
+    ttl seconds to keep the leadership.
+
+    The lease is renewed in its own transaction, so that campaigning in the
+    middle of a cycle neither commits nor rolls back the cycle's changes.
+
+    :param holder: Unique id of this instance; defaults to hostname:pid.
+    :param ttl: Seconds after which an unrenewed lease expires.
+    :param retry_interval: Seconds between two campaigns of a standby.
+    """
+
+    def __init__(self, holder=None, ttl=config.leader_lease_ttl,
+                 retry_interval=config.leader_retry_interval,
+                 name=LEADER_LEASE, engine=engine):
+        self.engine = engine
+        self.holder = holder or _default_holder()
+        self.ttl = ttl
+        self.retry_interval = retry_interval
+        self.name = name
+        self.is_leader = False
+
+    def campaign(self):
+        now = datetime.utcnow()
+        expires_at = now + timedelta(seconds=self.ttl)
+        leases = GuardianLease.__table__
+        try:
+            with self.engine.begin() as connection:
+                # Taking over an expired lease, or renewing ours, is a
+                # single conditional update so that only one instance can
+                # succeed.
+                renewed = connection.execute(leases.update().where(and_(
+                    leases.c.name == self.name,
+                    or_(leases.c.holder == self.holder,
+                        leases.c.expires_at < now))).values(
+                            holder=self.holder,
+                            expires_at=expires_at)).rowcount
+                if not renewed and not connection.execute(
+                        select([func.count()]).where(
+                            leases.c.name == self.name)).scalar():
+                    connection.execute(leases.insert().values(
+                        name=self.name, holder=self.holder,
+                        expires_at=expires_at))
+                    renewed = 1
+        except IntegrityError:
+            # Another instance created the lease first.
+            renewed = 0
+        except SQLAlchemyError:
+            logging.exception("Couldn't renew the leadership lease.")
+            renewed = 0
+        self.is_leader = bool(renewed)
+        return self.is_leader
+
+    def resign(self):
+        if not self.is_leader:
+            return
+        self.is_leader = False
+        leases = GuardianLease.__table__
+        try:
+            with self.engine.begin() as connection:
+                connection.execute(leases.delete().where(and_(
+                    leases.c.name == self.name,
+                    leases.c.holder == self.holder)))
+        except SQLAlchemyError:
+            pass
+
+
+def create_election():
+    """Returns the election suited to the configured database: an advisory
+    lock on PostgreSQL, a lease elsewhere.
+
+    :raises ValueError: If a lease would expire between two cycles.
+    """
+    if engine.dialect.name == 'postgresql':
+        return AdvisoryLockElection()
+    if config.leader_lease_ttl <= config.polling_interval_max:
+        raise ValueError("LEADER_LEASE_TTL must be longer than "
+                         "POLLING_INTERVAL_MAX.")
+    return LeaseElection()
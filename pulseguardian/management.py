@@ -2,70 +2,432 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import copy
 import json
 import logging
+import random
 import socket
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 from urllib import quote
 
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.exceptions import HTTPError
+
+from pulseguardian import config, jsoncodec
+from pulseguardian.snapshot import QueueSnapshot
 
 MAX_RETRY = 5
 
+# Weight of the latest response time in a node's average latency.
+LATENCY_WEIGHT = 0.3
+
 
 class PulseManagementException(Exception):
     pass
 
 
+class CircuitBreaker(object):
+    """Keeps track of consecutive failures of a remote service and stops
+    calls to it for a while once there were too many of them.
+
+    The breaker opens after failure_threshold consecutive failures.  While
+    it's open, allow() returns False until reset_timeout seconds have
+    elapsed; then a single trial call is let through, which closes the
+    breaker if it succeeds or opens it again if it fails.
+
+    :param failure_threshold: Consecutive failures before opening.
+    :param reset_timeout: Seconds to wait before letting a trial call
+                          through.
+    """
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self._trial or (time.time() - self.opened_at <
+                               self.reset_timeout):
+                return False
+            self._trial = True
+            return True
+
+    def success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                logging.info('Circuit breaker closed.')
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or (self.opened_at is None and
+                               self.failures >= self.failure_threshold):
+                if not self._trial:
+                    logging.warning('Circuit breaker opened after {0} '
+                                    'consecutive failures.'.format(
+                                        self.failures))
+                self.opened_at = time.time()
+                self._trial = False
+
+
+class ManagementNode(object):
+    """A management endpoint of the cluster, along with its health: a
+    circuit breaker, the time of its last failure and the average time it
+    takes to respond.
+
+    :param url: Management API URL of the node.
+    :param breaker: CircuitBreaker of the node.
+    """
+
+    def __init__(self, url, breaker):
+        self.url = url.rstrip('/') + '/'
+        self.breaker = breaker
+        # None until the node has responded once.
+        self.latency = None
+        self.failed_at = None
+
+    @property
+    def healthy(self):
+        """False if the node failed less than breaker.reset_timeout
+        seconds ago.
+        """
+        return (self.failed_at is None or
+                time.time() - self.failed_at >= self.breaker.reset_timeout)
+
+    def success(self, elapsed):
+        self.breaker.success()
+        self.failed_at = None
+        if self.latency is None:
+            self.latency = elapsed
+        else:
+            self.latency += LATENCY_WEIGHT * (elapsed - self.latency)
+
+    def failure(self):
+        self.breaker.failure()
+        self.failed_at = time.time()
+
+    def __repr__(self):
+        return "<ManagementNode(url='{0}')>".format(self.url)
+
+
 class PulseManagementAPI(object):
     """Wrapper around the RabbitMQ management plugin's REST API.
 
-    :param url: Management API URL.
+    Requests go through a single pooled HTTP session, so connections are
+    kept alive between calls.  Failed connections are retried with an
+    exponential backoff, and a circuit breaker stops calling the management
+    plugin for a while when it keeps failing.  Once the retries are
+    exhausted, or while the breaker is open, PulseManagementException is
+    raised.
+
+    The management API of a cluster can be reached through several of its
+    nodes.  Requests then go to the healthy node with the lowest latency,
+    failing over to the others when it can't be reached; the backoff only
+    starts once every node failed.  Each node has its own circuit breaker.
+
+    :param url: Management API URL, or several comma-separated (or a list
+                of them) for the nodes of a cluster.
     :param management_port: Port used by the management plugin.
     :param user: RabbitMQ user with administrator privilege.
     :param password: Password of the RabbitMQ user.
+    :param connect_timeout: Seconds to wait for a connection.
+    :param read_timeout: Seconds to wait for a response.
+    :param max_retry: Number of attempts for a single request.
+    :param backoff_base: Base delay, in seconds, of the backoff between
+                         attempts; it doubles after each attempt.
+    :param backoff_max: Maximum delay, in seconds, between attempts.
+    :param breaker: A CircuitBreaker for a single management URL; one is
+                    created from the config for each URL if None.
+    :param workers: Maximum number of concurrent requests made by the bulk
+                    operations (delete_queues, delete_users, ...); as many
+                    connections are pooled.
     """
     exception = PulseManagementException
 
-    def __init__(self, management_url, user, password):
-        self.management_url = management_url.rstrip('/') + '/'
+    def __init__(self, management_url, user, password,
+                 connect_timeout=config.rabbit_connect_timeout,
+                 read_timeout=config.rabbit_read_timeout,
+                 max_retry=MAX_RETRY,
+                 backoff_base=config.rabbit_backoff_base,
+                 backoff_max=config.rabbit_backoff_max,
+                 breaker=None, workers=config.rabbit_workers):
+        if isinstance(management_url, basestring):
+            management_url = management_url.split(',')
+        urls = [url.strip() for url in management_url if url.strip()]
+        if not urls:
+            raise ValueError("No management API URL.")
+        if breaker is not None and len(urls) > 1:
+            raise ValueError("A single breaker can't be shared by several "
+                             "management API URLs.")
         self.management_user = user
         self.management_password = password
 
-    def _api_request(self, path, method='GET', data=None):
-        session = requests.Session()
-        url = '{0}{1}'.format(self.management_url, path)
-        request = requests.Request(method, url,
-                                   auth=(self.management_user,
-                                         self.management_password),
-                                   data=json.dumps(data)).prepare()
-        request.headers['Content-type'] = 'application/json'
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retry = max_retry
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        if breaker is None:
+            self.nodes = [
+                ManagementNode(url, CircuitBreaker(
+                    config.rabbit_breaker_threshold,
+                    config.rabbit_breaker_reset_timeout))
+                for url in urls]
+        else:
+            self.nodes = [ManagementNode(urls[0], breaker)]
+        # Node to send requests to first, whatever its latency; see on_node.
+        self.preferred = None
+        self.workers = max(1, workers)
+
+        self.session = requests.Session()
+        self.session.auth = (user, password)
+        self.session.headers['Content-type'] = 'application/json'
+        # One pool per node: with fewer, the pool of a node would be closed
+        # while another is in use.
+        adapter = HTTPAdapter(pool_connections=len(self.nodes),
+                              pool_maxsize=self.workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _backoff(self, attempt):
+        """Returns the delay before a retry ("full jitter" backoff)."""
+        ceiling = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        return random.uniform(0, ceiling)
+
+    def available_nodes(self):
+        """Returns the healthy nodes, fastest first, or every node if none
+        is healthy.  Nodes which never responded come first, so that their
+        latency gets measured.
+        """
+        nodes = [node for node in self.nodes if node.healthy] or self.nodes
+        return sorted(nodes, key=lambda node: node.latency)
+
+    def on_node(self, node):
+        """Returns a copy of this API sending its requests to node first,
+        failing over to the others as usual.  The copy shares the
+        connections and the nodes' health with this API.
+        """
+        api = copy.copy(self)
+        api.preferred = node
+        return api
+
+    def _choose_node(self, tried):
+        """Returns the node to send the next attempt of a request to, or
+        None if every node's breaker is open.  Nodes which weren't tried yet
+        for this request come first, healthy ones before the others, then
+        the preferred one and the rest by latency.
+        """
+        def rank(node):
+            return (node in tried, not node.healthy,
+                    node is not self.preferred, node.latency)
+
+        for node in sorted(self.nodes, key=rank):
+            if node.breaker.allow():
+                return node
+        return None
+
+    def _send(self, path, method='GET', data=None, params=None,
+              stream=False):
+        """Sends a request, failing over to the other nodes and retrying
+        it if the server can't be reached, and returns the response.
+        """
+        body = json.dumps(data) if data is not None else None
         response = None
+        tried = set()
+        rounds = 0
 
-        for i in xrange(MAX_RETRY):
+        for i in xrange(self.max_retry):
+            node = self._choose_node(tried)
+            if node is None:
+                break
+            if node in tried:
+                # Every node failed; wait before trying them again.
+                time.sleep(self._backoff(rounds))
+                rounds += 1
+                tried = set()
+            tried.add(node)
+            url = '{0}{1}'.format(node.url, path)
+            start = time.time()
             try:
-                response = session.send(request)
+                response = self.session.request(method, url, data=body,
+                                                params=params, stream=stream,
+                                                timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout,
+                    socket.error):
+                logging.exception('Failed to connect to the RabbitMQ server '
+                                  'at {0}.'.format(node.url))
+                node.failure()
+            else:
+                node.success(time.time() - start)
                 break
-            except (requests.ConnectionError, socket.error):
-                logging.exception('Failed to connect to the RabbitMQ server.')
 
-        if response is None or not response.content:
+        if response is None:
+            raise PulseManagementException(
+                "Couldn't reach the RabbitMQ management API when calling "
+                "'{0} {1}'.".format(method, path))
+        return response
+
+    def _api_request(self, path, method='GET', data=None, params=None):
+        response = self._send(path, method=method, data=data, params=params)
+
+        if not response.content:
             return None
 
         try:
-            return response.json()
+            return jsoncodec.loads(response.content)
         except ValueError:
             raise PulseManagementException(
                 "Error when calling '{0} {1}' with data={2}. "
                 "Received: {3}".format(method, path, data, response.content))
 
+    def _api_stream(self, path, params=None):
+        """Yields the elements of the JSON array returned by a GET request
+        as they're decoded, without holding the whole response in memory.
+        """
+        response = self._send(path, params=params, stream=True)
+        try:
+            if response.status_code != 200:
+                raise PulseManagementException(
+                    "Error when calling 'GET {0}'. Received: {1}".format(
+                        path, response.content))
+            for item in jsoncodec.iter_response_array(response):
+                yield item
+        # Read directly from the socket by ijson, a response may also
+        # fail with urllib3's errors.
+        except (requests.RequestException, HTTPError, socket.error,
+                ValueError) as e:
+            raise PulseManagementException(
+                "Error when streaming 'GET {0}': {1}".format(path, e))
+        finally:
+            response.close()
+
+    def _bulk(self, func, items):
+        """Calls func with the arguments of each item concurrently, over at
+        most self.workers threads.
+
+        Returns a list of (item, error) pairs, in the order of items, where
+        error is None if the call succeeded, or the exception it raised or
+        the error reported by the API otherwise.
+        """
+        items = list(items)
+        if not items:
+            return []
+
+        def call(item):
+            try:
+                result = func(*item)
+            except Exception as e:
+                return item, e
+            # Errors such as a missing queue come back as a JSON body.
+            if isinstance(result, dict) and 'error' in result:
+                return item, PulseManagementException(
+                    result.get('reason', result['error']).strip())
+            return item, None
+
+        pool = ThreadPool(min(self.workers, len(items)))
+        try:
+            return pool.map(call, items)
+        finally:
+            pool.close()
+            pool.join()
+
     # Queues
 
-    def queues(self, vhost=None):
+    def _queues_path(self, vhost):
         if vhost:
-            vhost = quote(vhost, '')
-            return self._api_request('queues/{0}'.format(vhost))
+            return 'queues/{0}'.format(quote(vhost, ''))
+        return 'queues'
+
+    def queues(self, vhost=None, columns=None):
+        """Lists the queues, of a vhost or of all of them.
+
+        :param columns: If given, only these fields of each queue are
+                        returned; nested fields use dots, e.g.
+                        'message_stats.publish_details.rate'.
+        """
+        params = None
+        if columns:
+            params = dict(columns=','.join(columns))
+        return self._api_request(self._queues_path(vhost), params=params)
+
+    def stream_queues(self, vhost=None, columns=None):
+        """Like queues(), but yields the queues one at a time as the
+        response is decoded.
+        """
+        params = None
+        if columns:
+            params = dict(columns=','.join(columns))
+        return self._api_stream(self._queues_path(vhost), params=params)
+
+    def iter_queues(self, vhost=None, columns=None, page_size=500):
+        """Yields the queues one at a time, fetching them one page of
+        page_size queues (at most 500) at a time.
+
+        Pages are sorted by name.  Queues created or deleted while the
+        pages are fetched may shift the following pages, so a listing isn't
+        guaranteed to be a consistent view of the broker.
+        """
+        path = self._queues_path(vhost)
+        page = 1
+        while True:
+            params = dict(page=page, page_size=page_size, sort='name')
+            if columns:
+                params['columns'] = ','.join(columns)
+            result = self._api_request(path, params=params)
+            if not result:
+                return
+            # An error mustn't pass for the end of the listing.
+            if 'error' in result:
+                raise PulseManagementException(
+                    "Error when listing page {0} of the queues: {1}".format(
+                        page, result.get('reason', result['error'])))
+            for queue_data in result.get('items', []):
+                yield queue_data
+            if page >= result.get('page_count', 0):
+                return
+            page += 1
+
+    def queue_snapshots(self, vhost=None, page_size=0, stream=False):
+        """Yields a QueueSnapshot for each queue, parsed from a listing
+        restricted to the fields it needs.
+
+        :param page_size: If non-zero, the queues are fetched in pages of
+                          that many queues (see iter_queues).
+        :param stream: If True and page_size is 0, the listing is decoded
+                       incrementally (see stream_queues).
+        """
+        columns = QueueSnapshot.COLUMNS
+        if page_size:
+            queues = self.iter_queues(vhost, columns=columns,
+                                      page_size=page_size)
+        elif stream:
+            queues = self.stream_queues(vhost, columns=columns)
         else:
-            return self._api_request('queues')
+            queues = self.queues(vhost, columns=columns) or []
+            # Errors, e.g. for a vhost that was just deleted, come back as
+            # a JSON object.
+            if isinstance(queues, dict):
+                raise PulseManagementException(
+                    "Error when listing the queues of vhost '{0}': "
+                    "{1}".format(vhost, queues.get('reason',
+                                                   queues.get('error'))))
+        for queue_data in queues:
+            yield QueueSnapshot.from_api(queue_data)
 
     def queue(self, vhost, queue):
         vhost = quote(vhost, '')
@@ -75,12 +437,56 @@ class PulseManagementAPI(object):
     def delete_queue(self, vhost, queue):
         vhost = quote(vhost, '')
         queue = quote(queue, '')
-        self._api_request('queues/{0}/{1}'.format(vhost, queue),
-                          method='DELETE')
+        return self._api_request('queues/{0}/{1}'.format(vhost, queue),
+                                 method='DELETE')
+
+    def delete_queues(self, queues):
+        """Deletes queues concurrently.
+
+        :param queues: Iterable of (vhost, queue name) pairs.
+        :returns: List of ((vhost, queue name), error) pairs; see _bulk.
+        """
+        return self._bulk(self.delete_queue, queues)
 
     def delete_all_queues(self):
-        for queue_data in self.queues():
-            self.delete_queue(queue_data['vhost'], queue_data['name'])
+        queues = self.queues(columns=('vhost', 'name'))
+        # Don't go on with an error (a JSON object) or an empty response.
+        if not isinstance(queues, list):
+            raise PulseManagementException(
+                "Error when listing the queues: {0}".format(
+                    queues.get('reason', queues.get('error'))
+                    if isinstance(queues, dict) else queues))
+        results = self.delete_queues(
+            (queue_data['vhost'], queue_data['name'])
+            for queue_data in queues)
+        for (vhost, queue), error in results:
+            if error is not None:
+                logging.error("Couldn't delete queue '{0}': {1}".format(
+                    queue, error))
+
+    # Vhosts
+
+    def vhosts(self):
+        """Returns the names of the vhosts."""
+        vhosts = self._api_request('vhosts', params=dict(columns='name'))
+        if isinstance(vhosts, dict):
+            raise PulseManagementException(
+                "Error when listing the vhosts: {0}".format(
+                    vhosts.get('reason', vhosts.get('error'))))
+        return [vhost_data['name'] for vhost_data in vhosts or []]
+
+    # Bindings
+
+    def bindings(self, vhost=None):
+        """Yields the bindings, of a vhost or of all of them, restricted to
+        their source, destination and vhost.
+        """
+        if vhost:
+            path = 'bindings/{0}'.format(quote(vhost, ''))
+        else:
+            path = 'bindings'
+        columns = ('source', 'vhost', 'destination', 'destination_type')
+        return self._api_stream(path, params=dict(columns=','.join(columns)))
 
     # Users
 
@@ -91,12 +497,31 @@ class PulseManagementAPI(object):
     def create_user(self, username, password, tags=''):
         username = quote(username, '')
         data = dict(password=password, tags=tags)
-        self._api_request('users/{0}'.format(username), method='PUT',
-                          data=data)
+        return self._api_request('users/{0}'.format(username), method='PUT',
+                                 data=data)
+
+    def create_users(self, users):
+        """Creates users concurrently.
+
+        :param users: Iterable of (username, password) or (username,
+                      password, tags) tuples.
+        :returns: List of (user tuple, error) pairs; see _bulk.
+        """
+        return self._bulk(self.create_user, users)
 
     def delete_user(self, username):
         username = quote(username, '')
-        self._api_request('users/{0}'.format(username), method='DELETE')
+        return self._api_request('users/{0}'.format(username),
+                                 method='DELETE')
+
+    def delete_users(self, usernames):
+        """Deletes users concurrently.
+
+        :returns: List of (username, error) pairs; see _bulk.
+        """
+        results = self._bulk(self.delete_user,
+                             ((username,) for username in usernames))
+        return [(item[0], error) for item, error in results]
 
     # Permissions
 
@@ -104,9 +529,18 @@ class PulseManagementAPI(object):
         username = quote(username, '')
         vhost = quote(vhost, '')
         data = dict(configure=configure, write=write, read=read)
-        self._api_request('permissions/{0}/{1}'.format(
+        return self._api_request('permissions/{0}/{1}'.format(
             vhost, username), method='PUT', data=data)
 
+    def set_permissions(self, permissions):
+        """Sets permissions concurrently.
+
+        :param permissions: Iterable of (username, vhost, configure, write,
+                            read) tuples.
+        :returns: List of (permission tuple, error) pairs; see _bulk.
+        """
+        return self._bulk(self.set_permission, permissions)
+
     # Channels
 
     def channel(self, channel):
@@ -1,7 +1,8 @@
 import re
+from datetime import datetime
 
-from sqlalchemy import (Boolean, Column, ForeignKey,
-                        Integer, String, Table)
+from sqlalchemy import (Boolean, Column, DateTime, ForeignKey, Index,
+                        Integer, String, Table, and_)
 from sqlalchemy.orm import relationship
 
 from pulseguardian import config
@@ -127,9 +128,14 @@ queue_notification = Table('queue_notifications', Base.metadata,
 
 
 class Queue(Base):
+    """A RabbitMQ queue, identified by its vhost and name."""
+
     __tablename__ = 'queues'
+    # Led by the name, so that records can also be looked up by name alone.
+    __table_args__ = (Index('ix_queues_name_vhost', 'name', 'vhost'),)
 
     id = Column(Integer, primary_key=True)
+    vhost = Column(String(255), nullable=False, default='/')
     name = Column(String(255))
     owner_id = Column(Integer, ForeignKey('pulse_users.id'), nullable=True)
     size = Column(Integer)
@@ -169,9 +175,14 @@ class Queue(Base):
         db_session.commit()
 
     @staticmethod
-    def get_notifications(queue):
+    def get_notifications(queue, vhost='/'):
         return Email.query.filter(
-            Email.queues.any(Queue.name==queue)).all()
+            Email.queues.any(and_(Queue.vhost==vhost,
+                                  Queue.name==queue))).all()
+
+    @property
+    def key(self):
+        return (self.vhost, self.name)
 
     def __repr__(self):
         return "<Queue(name='{0}', owner='{1}')>".format(self.name, self.owner)
@@ -206,3 +217,80 @@ class Email(Base):
         return "<Email(address='{0}')>".format(self.address)
 
     __str__ = __repr__
+
+
+class ThresholdPolicy(Base):
+    """Warning and deletion thresholds overriding the global ones for some
+    queues: a single queue, the queues whose name starts with a prefix or
+    matches a regular expression, or the queues of a PulseUser.
+
+    A threshold left empty falls back to the global one.
+    """
+
+    __tablename__ = 'threshold_policies'
+
+    QUEUE = 'queue'
+    PREFIX = 'prefix'
+    REGEX = 'regex'
+    OWNER = 'owner'
+    KINDS = (QUEUE, PREFIX, REGEX, OWNER)
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(String(16), nullable=False)
+    # Queue name, prefix or regular expression, depending on the kind.
+    pattern = Column(String(255), nullable=True)
+    owner_id = Column(Integer, ForeignKey('pulse_users.id'), nullable=True)
+    # Regular expressions are tried in increasing order of rank.
+    rank = Column(Integer, nullable=False, default=0)
+    warn_queue_size = Column(Integer, nullable=True)
+    del_queue_size = Column(Integer, nullable=True)
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow,
+                        onupdate=datetime.utcnow)
+
+    owner = relationship('PulseUser', backref='threshold_policies')
+
+    def __repr__(self):
+        return ("<ThresholdPolicy(kind='{0}', pattern='{1}', owner='{2}', "
+                "warn_queue_size={3}, del_queue_size={4})>").format(
+                    self.kind, self.pattern, self.owner,
+                    self.warn_queue_size, self.del_queue_size)
+
+    __str__ = __repr__
+
+
+class GuardianWorker(Base):
+    """A running guardian process sharing the queues with the others (see
+    sharding.ShardCoordinator).  Workers whose heartbeat is too old are
+    considered gone.
+    """
+
+    __tablename__ = 'guardian_workers'
+
+    id = Column(String(255), primary_key=True)
+    heartbeat = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return "<GuardianWorker(id='{0}', heartbeat={1})>".format(
+            self.id, self.heartbeat)
+
+    __str__ = __repr__
+
+
+class GuardianLease(Base):
+    """Lease on a role (e.g. the leadership of the guardians) held by one
+    guardian at a time until it expires, unless renewed (see
+    leader.LeaseElection).
+    """
+
+    __tablename__ = 'guardian_leases'
+
+    name = Column(String(64), primary_key=True)
+    holder = Column(String(255), nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+
+    def __repr__(self):
+        return ("<GuardianLease(name='{0}', holder='{1}', "
+                "expires_at={2})>").format(self.name, self.holder,
+                                           self.expires_at)
+
+    __str__ = __repr__
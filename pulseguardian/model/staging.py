@@ -0,0 +1,143 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Set-based synchronization of the queues table with the queues that are
+alive on RabbitMQ.
+
+The live queues are bulk-loaded into a temporary staging table (with COPY on
+PostgreSQL, batched INSERTs elsewhere) and the queues table is then pruned
+and refreshed with a handful of statements, whatever the number of queues.
+"""
+
+from cStringIO import StringIO
+
+from sqlalchemy import (Boolean, Column, Integer, MetaData, String, Table,
+                        and_, exists, or_, select)
+
+from pulseguardian.model.models import Queue, queue_notification
+
+# Number of rows per INSERT when COPY isn't available.
+INSERT_BATCH_SIZE = 1000
+
+live_queues = Table('live_queues', MetaData(),
+                    Column('vhost', String(255), primary_key=True),
+                    Column('name', String(255), primary_key=True),
+                    Column('size', Integer),
+                    Column('durable', Boolean),
+                    prefixes=['TEMPORARY'])
+
+
+def _copy_escape(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def _copy_rows(connection, rows):
+    buf = StringIO()
+    for row in rows:
+        buf.write('\t'.join(_copy_escape(v) for v in row))
+        buf.write('\n')
+    buf.seek(0)
+
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert('COPY live_queues (vhost, name, size, durable) '
+                           'FROM STDIN', buf)
+    finally:
+        cursor.close()
+
+
+def _insert_rows(connection, rows):
+    batch = []
+    for vhost, name, size, durable in rows:
+        batch.append(dict(vhost=vhost, name=name, size=size,
+                          durable=durable))
+        if len(batch) >= INSERT_BATCH_SIZE:
+            connection.execute(live_queues.insert(), batch)
+            batch = []
+    if batch:
+        connection.execute(live_queues.insert(), batch)
+
+
+def load_live_queues(connection, rows):
+    """Creates the staging table and fills it with (vhost, name, size,
+    durable) rows.
+    """
+    live_queues.drop(connection, checkfirst=True)
+    live_queues.create(connection)
+    if connection.dialect.name == 'postgresql':
+        _copy_rows(connection, rows)
+    else:
+        _insert_rows(connection, rows)
+
+
+def _delete_records(connection, condition):
+    queues = Queue.__table__
+    connection.execute(queue_notification.delete().where(
+        queue_notification.c.queue_id.in_(
+            select([queues.c.id]).where(condition))))
+    connection.execute(queues.delete().where(condition))
+
+
+def _same_queue(live):
+    queues = Queue.__table__
+    return and_(live.c.vhost == queues.c.vhost, live.c.name == queues.c.name)
+
+
+def sync_queues(session, rows, owns=None):
+    """Deletes the records of the queues that aren't in rows anymore and
+    refreshes the size and durability of the others.
+
+    :param session: The session whose transaction is used.  The caller is
+                    responsible for committing it.
+    :param rows: Iterable of (vhost, name, size, durable) tuples for every
+                 queue alive on RabbitMQ.  The records of queues whose size
+                 is None are left as they are.
+    :param owns: If given, function returning True for the names of the
+                 queues handled by the caller (e.g. a guardian worker's
+                 shard); the records of the other queues are left alone.
+                 Their queues must still be in rows, with a None size if
+                 their records shouldn't be refreshed: only the records
+                 missing from rows are loaded and checked with owns.
+    :returns: The (vhost, name) of the deleted queues.
+    """
+    connection = session.connection()
+    load_live_queues(connection, rows)
+
+    queues = Queue.__table__
+    live = live_queues.alias('live')
+    same_queue = _same_queue(live)
+    gone = ~exists().where(same_queue)
+
+    deleted = connection.execute(
+        select([queues.c.id, queues.c.vhost, queues.c.name]).where(
+            gone)).fetchall()
+    if owns is not None:
+        deleted = [row for row in deleted if owns(row[2])]
+        ids = [row[0] for row in deleted]
+        for i in xrange(0, len(ids), INSERT_BATCH_SIZE):
+            _delete_records(connection, queues.c.id.in_(
+                ids[i:i + INSERT_BATCH_SIZE]))
+    elif deleted:
+        _delete_records(connection, gone)
+
+    # Only rewrite the rows that actually drifted.
+    drifted = exists().where(and_(
+        same_queue,
+        live.c.size != None,
+        or_(queues.c.size == None,
+            live.c.size != queues.c.size,
+            live.c.durable != queues.c.durable)))
+    connection.execute(queues.update().where(drifted).values(
+        size=select([live.c.size]).where(same_queue).as_scalar(),
+        durable=select([live.c.durable]).where(same_queue).as_scalar()))
+
+    live_queues.drop(connection)
+    return [(vhost, name) for queue_id, vhost, name in deleted]
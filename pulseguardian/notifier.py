@@ -0,0 +1,319 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import logging
+import threading
+import time
+from Queue import Empty, Full, Queue
+
+from pulseguardian import config
+from pulseguardian.sendemail import SMTPClient, build_message
+
+
+class Notification(object):
+    """An email waiting to be sent."""
+
+    __slots__ = ('subject', 'body', 'to_addrs', 'created')
+
+    def __init__(self, subject, body, to_addrs):
+        self.subject = subject
+        self.body = body
+        self.to_addrs = to_addrs
+        self.created = time.time()
+
+    def __repr__(self):
+        return "<Notification(subject='{0}', to_addrs={1})>".format(
+            self.subject, self.to_addrs)
+
+    __str__ = __repr__
+
+
+class SMTPTransport(object):
+    """Delivers batches of notifications over a persistent connection to the
+    configured SMTP server.
+    """
+
+    def __init__(self):
+        self.client = SMTPClient(server=config.email_smtp_server,
+                                 port=config.email_smtp_port,
+                                 username=config.email_account,
+                                 password=config.email_password,
+                                 use_ssl=config.email_ssl)
+
+    def send_many(self, notifications):
+        """Returns, for each notification, None if it was sent or the
+        exception that prevented it.
+        """
+        messages = [(config.email_from, n.to_addrs,
+                     build_message(from_addr=config.email_from,
+                                   to_addrs=n.to_addrs,
+                                   subject=n.subject,
+                                   text_data=n.body))
+                    for n in notifications]
+        return self.client.send_many(messages)
+
+    def close(self):
+        self.client.close()
+
+
+class CallbackTransport(object):
+    """Delivers notifications one at a time by calling a function."""
+
+    def __init__(self, send):
+        self.send = send
+
+    def send_many(self, notifications):
+        results = []
+        for notification in notifications:
+            try:
+                self.send(notification)
+            except Exception as e:
+                results.append(e)
+            else:
+                results.append(None)
+        return results
+
+    def close(self):
+        pass
+
+
+class Notifier(object):
+    """Sends notifications from a pool of worker threads, so that callers
+    never wait for the mail server.
+
+    Notifications are put on a bounded in-process queue; if it's full, new
+    notifications are dropped (and counted as such) rather than blocking
+    the caller.  Each worker keeps its own connection to the mail server
+    and sends the notifications waiting in the queue in batches over it.
+
+    :param workers: Number of worker threads.
+    :param max_pending: Maximum number of notifications waiting to be sent.
+    :param send: Function called with a Notification to deliver it; the
+                 configured SMTP server is used if None.
+    :param batch_size: Maximum number of notifications a worker takes from
+                       the queue at once.
+    """
+
+    def __init__(self, workers=config.email_workers,
+                 max_pending=config.email_max_pending,
+                 send=None, batch_size=config.email_batch_size):
+        self.send = send
+        self.batch_size = batch_size
+        self.queue = Queue(maxsize=max_pending)
+        self._lock = threading.Lock()
+        self._metrics = dict(queued=0, sent=0, failed=0, dropped=0,
+                             delivery_time=0.0)
+
+        self.workers = []
+        for i in xrange(workers):
+            worker = threading.Thread(target=self._work,
+                                      name='notifier-{0}'.format(i))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def _count(self, metric, value=1):
+        with self._lock:
+            self._metrics[metric] += value
+
+    def metrics(self):
+        """Returns the delivery counters: notifications queued, sent,
+        failed and dropped, the number still pending and the average time
+        between queueing and delivery.
+        """
+        with self._lock:
+            metrics = dict(self._metrics)
+        metrics['pending'] = self.queue.unfinished_tasks
+        delivery_time = metrics.pop('delivery_time')
+        metrics['average_delivery_time'] = (
+            delivery_time / metrics['sent'] if metrics['sent'] else 0.0)
+        return metrics
+
+    def notify(self, subject, body, to_addrs):
+        """Queues an email.  Returns False if it was dropped."""
+        notification = Notification(subject, body, to_addrs)
+        try:
+            self.queue.put_nowait(notification)
+        except Full:
+            logging.warning("Notification queue is full; dropping "
+                            "{0}.".format(notification))
+            self._count('dropped')
+            return False
+        self._count('queued')
+        return True
+
+    def _transport(self):
+        if self.send is None:
+            return SMTPTransport()
+        return CallbackTransport(self.send)
+
+    def _next_batch(self):
+        """Waits for a notification and returns it along with the ones
+        already waiting, up to batch_size.  A None in the queue (the stop
+        sentinel) ends the batch.
+        """
+        batch = [self.queue.get()]
+        while batch[-1] is not None and len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def _work(self):
+        transport = self._transport()
+        try:
+            while True:
+                batch = self._next_batch()
+                try:
+                    notifications = [n for n in batch if n is not None]
+                    if notifications:
+                        self._deliver(transport, notifications)
+                finally:
+                    for item in batch:
+                        self.queue.task_done()
+                if batch[-1] is None:
+                    return
+        finally:
+            transport.close()
+
+    def _deliver(self, transport, notifications):
+        try:
+            results = transport.send_many(notifications)
+        except Exception as e:
+            # E.g. the connection to the server couldn't be opened.
+            results = [e] * len(notifications)
+
+        for notification, error in zip(notifications, results):
+            if error is not None:
+                logging.error("Couldn't send {0}: {1}".format(notification,
+                                                             error))
+                self._count('failed')
+            else:
+                self._count('sent')
+                self._count('delivery_time',
+                            time.time() - notification.created)
+
+    def flush(self, timeout=None):
+        """Waits until every queued notification has been handled.  Returns
+        False if some are still pending after timeout seconds.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                if deadline is None:
+                    self.queue.all_tasks_done.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.queue.all_tasks_done.wait(remaining)
+        return True
+
+    def shutdown(self, timeout=config.email_shutdown_timeout):
+        """Flushes the pending notifications and stops the workers."""
+        if not self.flush(timeout):
+            logging.warning("{0} notifications were still pending at "
+                            "shutdown.".format(self.queue.unfinished_tasks))
+            # Discard them so that the workers see the sentinels.
+            try:
+                while True:
+                    self.queue.get_nowait()
+                    self.queue.task_done()
+            except Empty:
+                pass
+        for worker in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join(timeout)
+        logging.info("Notifier stopped: {0}".format(self.metrics()))
+
+
+class DigestNotifier(object):
+    """Coalesces the notifications sent to each recipient over a time window
+    into a single summary email, sent through a Notifier.
+
+    The first notification for a recipient opens its window; when the
+    window closes, everything received meanwhile is sent as one email (or
+    unchanged, if there was a single notification).
+
+    :param notifier: Notifier delivering the digests.
+    :param window: Length of the coalescing window, in seconds.
+    """
+
+    def __init__(self, notifier, window=config.email_digest_window):
+        self.notifier = notifier
+        self.window = window
+        # Recipient -> (window's end, [(subject, body), ...]).
+        self._digests = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_periodically,
+                                         name='digest-flusher')
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def notify(self, subject, body, to_addrs):
+        """Adds a notification to the digest of each recipient."""
+        now = time.time()
+        with self._lock:
+            for address in to_addrs:
+                if address not in self._digests:
+                    self._digests[address] = (now + self.window, [])
+                self._digests[address][1].append((subject, body))
+        return True
+
+    def _flush_periodically(self):
+        interval = min(1.0, self.window / 4.0)
+        while not self._stop.wait(interval):
+            self.flush_due()
+
+    def flush_due(self, now=None, force=False):
+        """Sends the digests whose window is over (every digest if force is
+        True).  Returns the number of digests sent.
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            due = [address for address, (end, entries)
+                   in self._digests.iteritems() if force or end <= now]
+            digests = [(address, self._digests.pop(address)[1])
+                       for address in due]
+
+        for address, entries in digests:
+            subject, body = self._summarize(entries)
+            self.notifier.notify(subject, body, [address])
+        return len(digests)
+
+    def _summarize(self, entries):
+        if len(entries) == 1:
+            return entries[0]
+
+        subject = 'Pulse: {0} notifications about your queues'.format(
+            len(entries))
+        if self.window < 60:
+            window = '{0:g} seconds'.format(self.window)
+        else:
+            window = '{0} minutes'.format(int(round(self.window / 60.0)))
+        parts = ['The following happened to your Pulse queues in the last '
+                 '{0}.\n'.format(window)]
+        for entry_subject, entry_body in entries:
+            parts.append('* {0}\n\n{1}'.format(entry_subject, entry_body))
+        return subject, '\n'.join(parts)
+
+    def metrics(self):
+        metrics = self.notifier.metrics()
+        with self._lock:
+            metrics['held'] = sum(len(entries) for end, entries
+                                  in self._digests.itervalues())
+        return metrics
+
+    def shutdown(self, timeout=config.email_shutdown_timeout):
+        """Sends every digest, open windows included, and stops the
+        notifier.
+        """
+        self._stop.set()
+        self._flusher.join(timeout)
+        self.flush_due(force=True)
+        self.notifier.shutdown(timeout)
@@ -0,0 +1,89 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import collections
+import logging
+import threading
+import time
+
+
+class Handoff(object):
+    """Bounded buffer passing queue listings from a fetcher to the guardian.
+
+    Only the most recent state of the broker matters, so when the buffer is
+    full the oldest listing is dropped to make room for the new one rather
+    than blocking the fetcher.
+
+    :param size: Maximum number of listings held.
+    """
+
+    def __init__(self, size=1):
+        self._items = collections.deque(maxlen=max(1, size))
+        self._cond = threading.Condition()
+        self.dropped = 0
+
+    def put(self, item):
+        with self._cond:
+            if len(self._items) == self._items.maxlen:
+                self.dropped += 1
+            self._items.append(item)
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """Returns the oldest item held, waiting up to timeout seconds for
+        one; None if there's none by then.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while not self._items:
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return None
+                    self._cond.wait(remaining)
+            return self._items.popleft()
+
+
+class SnapshotFetcher(threading.Thread):
+    """Thread fetching a queue listing every interval seconds and putting
+    it, along with the time the fetch started, in a Handoff.
+
+    :param fetch: Function returning an iterable of QueueSnapshots.
+    :param handoff: The Handoff the listings are put in.
+    :param interval: Seconds between the start of two fetches.
+    :param exception: Exception raised by fetch when the management API is
+                      unavailable; the fetch is then skipped.
+    :param active: Function returning False when fetches must be skipped
+                   (e.g. while the guardian is a standby).
+    """
+
+    def __init__(self, fetch, handoff, interval, exception, active=None):
+        threading.Thread.__init__(self, name='snapshot-fetcher')
+        self.daemon = True
+        self.fetch = fetch
+        self.handoff = handoff
+        self.interval = interval
+        self.exception = exception
+        self.active = active
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            started = time.time()
+            if self.active is None or self.active():
+                try:
+                    queues = list(self.fetch())
+                except self.exception:
+                    logging.exception("The RabbitMQ management API is "
+                                      "unavailable; skipping this fetch.")
+                else:
+                    self.handoff.put((started, queues))
+            self._stop_event.wait(
+                max(0, self.interval - (time.time() - started)))
+
+    def stop(self, timeout=None):
+        self._stop_event.set()
+        self.join(timeout)
@@ -0,0 +1,173 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import logging
+import re
+
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload
+
+from pulseguardian.model.models import ThresholdPolicy
+
+# Key of the thresholds stored at a node of the prefix trie.
+_LEAF = None
+
+# Maximum number of cached resolutions; the cache is emptied beyond that, so
+# that the names of queues which are gone don't pile up.
+CACHE_SIZE = 100000
+
+
+def _check(policy):
+    """Returns what's wrong with the thresholds of a policy, or None."""
+    warn_queue_size, del_queue_size = (policy.warn_queue_size,
+                                       policy.del_queue_size)
+    for size in warn_queue_size, del_queue_size:
+        if size is not None and size < 0:
+            return "negative threshold"
+    if (warn_queue_size is not None and del_queue_size is not None and
+            warn_queue_size > del_queue_size):
+        return "warning threshold over the deletion threshold"
+    return None
+
+
+def _merge(policy, defaults):
+    warn_queue_size, del_queue_size = defaults
+    if policy.warn_queue_size is not None:
+        warn_queue_size = policy.warn_queue_size
+    if policy.del_queue_size is not None:
+        del_queue_size = policy.del_queue_size
+    return warn_queue_size, del_queue_size
+
+
+class PolicyIndex(object):
+    """Threshold policies compiled for fast lookups by queue name.
+
+    A queue gets the thresholds of the first policy it matches, in this
+    order: a policy for its exact name, the policy with the longest prefix
+    of its name, the first regular expression (by rank) matching its name,
+    the policy of its owner.  Queues matching no policy get the defaults.
+    Resolutions are cached, the index being rebuilt when policies change.
+    Policies with negative thresholds, or with a warning threshold over
+    their deletion threshold, are ignored.
+
+    :param policies: Iterable of ThresholdPolicy.
+    :param defaults: Global (warn_queue_size, del_queue_size).
+    :param owner_name: Function returning the name of a queue's owner, or
+                       None.
+    :param cache_size: Maximum number of cached resolutions.
+    """
+
+    def __init__(self, policies, defaults, owner_name,
+                 cache_size=CACHE_SIZE):
+        self.defaults = defaults
+        self.owner_name = owner_name
+        self.cache_size = cache_size
+        self.exact = {}
+        self.trie = {}
+        self.regexes = []
+        self.owners = {}
+        self._cache = {}
+
+        for policy in sorted(policies, key=lambda p: (p.rank, p.id)):
+            error = _check(policy)
+            if error is not None:
+                logging.error("Ignoring {0}: {1}.".format(policy, error))
+                continue
+            thresholds = _merge(policy, defaults)
+            if policy.kind == ThresholdPolicy.QUEUE:
+                self.exact.setdefault(policy.pattern, thresholds)
+            elif policy.kind == ThresholdPolicy.PREFIX:
+                node = self.trie
+                for c in policy.pattern:
+                    node = node.setdefault(c, {})
+                node.setdefault(_LEAF, thresholds)
+            elif policy.kind == ThresholdPolicy.REGEX:
+                try:
+                    self.regexes.append((re.compile(policy.pattern),
+                                         thresholds))
+                except re.error as e:
+                    logging.error("Ignoring {0}: {1}".format(policy, e))
+            elif policy.kind == ThresholdPolicy.OWNER and policy.owner:
+                self.owners.setdefault(policy.owner.username, thresholds)
+            else:
+                logging.error("Ignoring invalid {0}.".format(policy))
+        self._empty = len(self) == 0
+
+    def __len__(self):
+        return (len(self.exact) + len(self.regexes) + len(self.owners) +
+                bool(self.trie))
+
+    def _longest_prefix(self, name):
+        node, found = self.trie, self.trie.get(_LEAF)
+        for c in name:
+            node = node.get(c)
+            if node is None:
+                break
+            found = node.get(_LEAF, found)
+        return found
+
+    def _resolve(self, name):
+        thresholds = self.exact.get(name)
+        if thresholds is None and self.trie:
+            thresholds = self._longest_prefix(name)
+        if thresholds is None:
+            for regex, regex_thresholds in self.regexes:
+                if regex.match(name):
+                    thresholds = regex_thresholds
+                    break
+        if thresholds is None and self.owners:
+            thresholds = self.owners.get(self.owner_name(name))
+        return thresholds or self.defaults
+
+    def resolve(self, name):
+        """Returns the (warn_queue_size, del_queue_size) of a queue."""
+        if self._empty:
+            return self.defaults
+        thresholds = self._cache.get(name)
+        if thresholds is None:
+            if len(self._cache) >= self.cache_size:
+                self._cache.clear()
+            thresholds = self._cache[name] = self._resolve(name)
+        return thresholds
+
+
+class ThresholdPolicies(object):
+    """Keeps a PolicyIndex of the policies in the database up to date.
+
+    :param warn_queue_size: Default warning threshold.
+    :param del_queue_size: Default deletion threshold.
+    :param owner_name: Function returning the name of a queue's owner.
+    """
+
+    def __init__(self, warn_queue_size, del_queue_size, owner_name):
+        self.defaults = (warn_queue_size, del_queue_size)
+        self.owner_name = owner_name
+        self.index = PolicyIndex([], self.defaults, owner_name)
+        self._version = None
+
+    def refresh(self):
+        """Recompiles the index if the policies changed since the last
+        call; this costs a single small query otherwise.  Returns True if
+        the index was recompiled.
+        """
+        version = ThresholdPolicy.query.with_entities(
+            func.count(ThresholdPolicy.id),
+            func.max(ThresholdPolicy.updated_at)).one()
+        version = tuple(version)
+        if version == self._version:
+            return False
+        policies = ThresholdPolicy.query.options(
+            joinedload('owner')).all()
+        self.index = PolicyIndex(policies, self.defaults, self.owner_name)
+        self._version = version
+        logging.info("Loaded {0} threshold policies.".format(len(policies)))
+        return True
+
+    def resolve(self, name):
+        return self.index.resolve(name)
+
+    @property
+    def overridden(self):
+        """True if any policy overrides the default thresholds."""
+        return len(self.index) > 0
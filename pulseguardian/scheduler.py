@@ -0,0 +1,133 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import time
+
+from pulseguardian import config
+from pulseguardian.snapshot import QueueSnapshot
+
+
+class PollingScheduler(object):
+    """Chooses the delay before the next poll of the queues from how soon a
+    queue could cross the warning or deletion threshold.
+
+    Each queue's growth rate is the larger of the rate reported by the
+    management API and the one observed between the last two polls.  The
+    next poll is scheduled after half the shortest time a growing queue
+    needs to reach its next threshold, so that it's seen at least once
+    more before crossing it, and never later than max_interval or sooner
+    than min_interval.  When no queue is getting close, the interval grows
+    by a factor of backoff after each poll, up to max_interval.
+
+    :param warn_queue_size: Default warning threshold.
+    :param del_queue_size: Default deletion threshold.
+    :param min_interval: Shortest delay between polls, in seconds.
+    :param max_interval: Longest delay between polls, in seconds.
+    :param backoff: Factor by which the interval grows when it's quiet.
+    :param resolve: Function returning the (warning, deletion) thresholds
+                    of a queue given its name, if they can differ from the
+                    defaults.
+    """
+
+    def __init__(self, warn_queue_size, del_queue_size,
+                 min_interval=config.polling_interval_min,
+                 max_interval=config.polling_interval_max, backoff=1.5,
+                 resolve=None):
+        if max_interval < min_interval:
+            raise ValueError("The maximum polling interval can't be smaller "
+                             "than the minimum one.")
+        self.thresholds = (warn_queue_size, del_queue_size)
+        self.resolve = resolve
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.interval = min_interval
+
+        # (vhost, queue name) -> (number of messages, time) at the last poll.
+        self._sizes = {}
+        # (vhost, queue name) -> growth rate, in messages per second, of the
+        # queues which were growing at the last poll.
+        self.rates = {}
+        # Vhost (None for all of them) -> shortest time before a queue of
+        # the vhost crosses a threshold, as of its last poll (None if no
+        # queue is growing towards one).
+        self._soonest = {}
+        self.time_to_threshold = None
+
+    def _time_to_threshold(self, messages, rate, thresholds):
+        if rate <= 0:
+            return None
+        for threshold in thresholds:
+            if messages <= threshold:
+                return (threshold - messages) / float(rate)
+        return None
+
+    def observe(self, queues, vhost=None):
+        """Yields the queues of a listing as QueueSnapshots, recording their
+        size and growth along the way.  If vhost is given, the listing only
+        covers that vhost and what was recorded about the others is kept.
+        """
+        now = time.time()
+        sizes = {}
+        rates = {}
+        soonest = None
+        for queue_data in queues:
+            queue_data = QueueSnapshot.coerce(queue_data)
+            yield queue_data
+            if queue_data.messages is None:
+                continue
+            key = queue_data.key
+            sizes[key] = (queue_data.messages, now)
+
+            rate = queue_data.growth_rate
+            previous = self._sizes.get(key)
+            if previous is not None and now > previous[1]:
+                rate = max(rate, (queue_data.messages - previous[0]) /
+                           (now - previous[1]))
+            if rate > 0:
+                rates[key] = rate
+            if self.resolve is None:
+                thresholds = self.thresholds
+            else:
+                thresholds = self.resolve(queue_data.name)
+            remaining = self._time_to_threshold(queue_data.messages, rate,
+                                                thresholds)
+            if remaining is not None and (soonest is None or
+                                          remaining < soonest):
+                soonest = remaining
+
+        if vhost is None:
+            self._sizes = sizes
+            self.rates = rates
+            self._soonest = {}
+        else:
+            for recorded in (self._sizes, self.rates):
+                for key in [key for key in recorded if key[0] == vhost]:
+                    del recorded[key]
+            self._sizes.update(sizes)
+            self.rates.update(rates)
+            self._soonest.pop(None, None)
+        self._soonest[vhost] = soonest
+        known = [t for t in self._soonest.itervalues() if t is not None]
+        self.time_to_threshold = min(known) if known else None
+
+    def growth_rate(self, name, vhost='/'):
+        """Returns the growth rate of a queue, in messages per second, as
+        of the last poll; 0 if it wasn't growing.
+        """
+        return self.rates.get((vhost, name), 0.0)
+
+    def next_interval(self):
+        """Returns the number of seconds to wait before the next poll."""
+        if self.time_to_threshold is None:
+            target = self.max_interval
+        else:
+            target = self.time_to_threshold / 2.0
+        if target < self.interval:
+            interval = target
+        else:
+            interval = min(target, self.interval * self.backoff)
+        self.interval = max(self.min_interval,
+                            min(self.max_interval, interval))
+        return self.interval
@@ -3,6 +3,7 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import smtplib
+import socket
 import sys
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
@@ -12,7 +13,6 @@ if sys.hexversion < 0x020603f0:
     #     http://bugs.python.org/issue4066
     # Unfortunately the stock version of Python in Snow Leopard is 2.6.1, so
     # we patch it here to avoid having to install an updated Python version.
-    import socket
     import ssl
     from os import stderr
 
@@ -27,35 +27,14 @@ if sys.hexversion < 0x020603f0:
     smtplib.SMTP_SSL._get_socket = _get_socket_fixed
 
 
-def sendemail(from_addr=None, to_addrs=None, subject='No Subject',
-              text_data=None, html_data=None,
-              server='smtp.mozilla.org', port=25,
-              username=None, password=None, use_ssl=False):
-    """Sends an email.
-
-     from_addr is an email address; to_addrs is a list of email adresses.
-     Addresses can be plain (e.g. "jsmith@example.com") or with real names
-     (e.g. "John Smith <jsmith@example.com>").
-
-     text_data and html_data are both strings.  You can specify one or both.
-     If you specify both, the email will be sent as a MIME multipart
-     alternative, i.e., the recipient will see the HTML content if his
-     viewer supports it; otherwise he'll see the text content.
-     """
-
+def build_message(from_addr=None, to_addrs=None, subject='No Subject',
+                  text_data=None, html_data=None):
+    """Builds an email message; see sendemail for the arguments."""
     if not from_addr or not to_addrs:
         raise Exception("Both from_addr and to_addrs must be specified")
     if not text_data and not html_data:
         raise Exception("Must specify either text_data or html_data")
 
-    if use_ssl:
-        server = smtplib.SMTP_SSL(server, port)
-    else:
-        server = smtplib.SMTP(server, port)
-
-    if username and password:
-        server.login(username, password)
-
     if not html_data:
         msg = MIMEText(text_data)
     elif not text_data:
@@ -70,7 +49,125 @@ def sendemail(from_addr=None, to_addrs=None, subject='No Subject',
     msg['Subject'] = subject
     msg['From'] = from_addr
     msg['To'] = ', '.join(to_addrs)
+    return msg
+
+
+class SMTPClient(object):
+    """Persistent connection to an SMTP server, used to send many messages
+    with a single connection and login.
+
+    The connection is opened on first use and reopened if the server
+    dropped it, e.g. after being idle.
+
+    :param max_messages: Number of messages after which the connection is
+                         renewed, since some servers limit how many can be
+                         sent over one connection; 0 for no limit.
+    """
 
-    server.sendmail(from_addr, to_addrs, msg.as_string())
+    def __init__(self, server='smtp.mozilla.org', port=25, username=None,
+                 password=None, use_ssl=False, timeout=60, max_messages=100):
+        self.server = server
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self.max_messages = max_messages
+        self.connection = None
+        self._sent = 0
 
-    server.quit()
+    def connect(self):
+        self.close()
+        if self.use_ssl:
+            connection = smtplib.SMTP_SSL(self.server, self.port,
+                                          timeout=self.timeout)
+        else:
+            connection = smtplib.SMTP(self.server, self.port,
+                                      timeout=self.timeout)
+        if self.username and self.password:
+            connection.login(self.username, self.password)
+        self.connection = connection
+        self._sent = 0
+
+    def close(self):
+        if self.connection is None:
+            return
+        try:
+            self.connection.quit()
+        except (smtplib.SMTPException, socket.error):
+            # The server may already have dropped the connection.
+            pass
+        self.connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def send(self, from_addr, to_addrs, msg):
+        """Sends a message, reconnecting once if the connection was lost."""
+        if self.max_messages and self._sent >= self.max_messages:
+            self.close()
+        for attempt in (0, 1):
+            if self.connection is None:
+                self.connect()
+            try:
+                self.connection.sendmail(from_addr, to_addrs,
+                                         msg.as_string())
+                break
+            except (smtplib.SMTPServerDisconnected, socket.error):
+                # Don't leave the old socket open.
+                try:
+                    self.connection.close()
+                except socket.error:
+                    pass
+                self.connection = None
+                if attempt:
+                    raise
+        self._sent += 1
+
+    def send_many(self, messages):
+        """Sends (from_addr, to_addrs, msg) tuples over the connection.
+        Returns a list with, for each message, None if it was sent or the
+        exception raised while sending it.  If the server can't be reached,
+        the remaining messages fail with the same exception without further
+        connection attempts.
+        """
+        results = []
+        for from_addr, to_addrs, msg in messages:
+            try:
+                self.send(from_addr, to_addrs, msg)
+            except (smtplib.SMTPException, socket.error) as e:
+                results.append(e)
+                if self.connection is None:
+                    results.extend([e] * (len(messages) - len(results)))
+                    break
+            else:
+                results.append(None)
+        return results
+
+
+def sendemail(from_addr=None, to_addrs=None, subject='No Subject',
+              text_data=None, html_data=None,
+              server='smtp.mozilla.org', port=25,
+              username=None, password=None, use_ssl=False):
+    """Sends an email.
+
+     from_addr is an email address; to_addrs is a list of email adresses.
+     Addresses can be plain (e.g. "jsmith@example.com") or with real names
+     (e.g. "John Smith <jsmith@example.com>").
+
+     text_data and html_data are both strings.  You can specify one or both.
+     If you specify both, the email will be sent as a MIME multipart
+     alternative, i.e., the recipient will see the HTML content if his
+     viewer supports it; otherwise he'll see the text content.
+
+     To send several emails over a single connection, use SMTPClient.
+     """
+    msg = build_message(from_addr=from_addr, to_addrs=to_addrs,
+                        subject=subject, text_data=text_data,
+                        html_data=html_data)
+    with SMTPClient(server=server, port=port, username=username,
+                    password=password, use_ssl=use_ssl) as client:
+        client.send(from_addr, to_addrs, msg)
@@ -0,0 +1,128 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Splitting of the queues between several guardian workers.
+
+Each worker registers itself in the guardian_workers table and refreshes its
+heartbeat there at every cycle.  The workers with a recent heartbeat are
+placed on a consistent hash ring, and each queue is handled by the worker
+its name hashes to, so that when a worker joins or leaves only the queues
+of that worker's share change hands.
+"""
+
+import bisect
+import hashlib
+import logging
+import os
+import socket
+from datetime import datetime, timedelta
+
+from pulseguardian import config
+from pulseguardian.model.base import db_session
+from pulseguardian.model.models import GuardianWorker
+
+# Number of points of each worker on the ring; more points spread the queues
+# more evenly.
+REPLICAS = 100
+
+
+def _hash(key):
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """Consistent hash ring mapping keys to workers.
+
+    :param workers: Iterable of worker ids.
+    :param replicas: Number of points of each worker on the ring.
+    """
+
+    def __init__(self, workers, replicas=REPLICAS):
+        self.workers = frozenset(workers)
+        points = sorted((_hash('{0}#{1}'.format(worker, i)), worker)
+                        for worker in self.workers
+                        for i in xrange(replicas))
+        self._hashes = [h for h, worker in points]
+        self._workers = [worker for h, worker in points]
+
+    def owner(self, key):
+        """Returns the worker a key is assigned to, or None if there are
+        no workers.
+        """
+        if not self._hashes:
+            return None
+        i = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._workers[i]
+
+
+class ShardCoordinator(object):
+    """Membership of a guardian in the pool of workers sharing the queues,
+    coordinated through the database.
+
+    Workers may briefly disagree on the membership after a change, until
+    each has seen it at its next heartbeat; a queue may then be looked at
+    by two workers, or none, for a cycle.
+
+    :param worker_id: Unique id of this worker; defaults to hostname:pid.
+    :param heartbeat_timeout: Seconds without a heartbeat after which a
+                              worker is considered gone.
+    """
+
+    def __init__(self, worker_id=config.guardian_worker_id,
+                 heartbeat_timeout=config.shard_heartbeat_timeout,
+                 replicas=REPLICAS):
+        if worker_id is None:
+            worker_id = '{0}:{1}'.format(socket.gethostname(), os.getpid())
+        self.worker_id = worker_id
+        self.heartbeat_timeout = heartbeat_timeout
+        self.replicas = replicas
+        # Until the first heartbeat, this worker handles every queue.
+        self.ring = HashRing([worker_id], replicas)
+
+    def heartbeat(self):
+        """Records that this worker is alive, forgets the workers that
+        aren't and refreshes the ring.  Returns True if the membership
+        changed since the last call.
+        """
+        now = datetime.utcnow()
+        try:
+            worker = GuardianWorker.query.get(self.worker_id)
+            if worker is None:
+                db_session.add(GuardianWorker(id=self.worker_id,
+                                              heartbeat=now))
+            else:
+                worker.heartbeat = now
+            db_session.flush()
+            expired = now - timedelta(seconds=self.heartbeat_timeout)
+            GuardianWorker.query.filter(
+                GuardianWorker.heartbeat < expired).delete(
+                    synchronize_session=False)
+            workers = [worker_id for worker_id, in
+                       db_session.query(GuardianWorker.id)]
+        except Exception:
+            db_session.rollback()
+            raise
+        db_session.commit()
+
+        if frozenset(workers) == self.ring.workers:
+            return False
+        logging.info("Guardian workers: {0}; this is {1}.".format(
+            ', '.join(sorted(workers)), self.worker_id))
+        self.ring = HashRing(workers, self.replicas)
+        return True
+
+    def owns(self, queue_name):
+        """Returns True if this worker handles the queue."""
+        return self.ring.owner(queue_name) == self.worker_id
+
+    def leave(self):
+        """Unregisters this worker, so that the others take over its queues
+        without waiting for its heartbeat to expire.
+        """
+        GuardianWorker.query.filter(
+            GuardianWorker.id == self.worker_id).delete(
+                synchronize_session=False)
+        db_session.commit()
@@ -0,0 +1,112 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Fields measuring, in bytes, how much of the broker's memory a queue uses:
+# the size of its messages, the size of those held in RAM and the memory
+# used by the queue's process.
+RESOURCE_METRICS = ('message_bytes', 'message_bytes_ram', 'memory')
+
+
+class QueueSnapshot(object):
+    """State of a RabbitMQ queue at polling time.
+
+    Only the fields used by the guardian are kept, in slots, instead of the
+    whole dict returned by the management API with its many nested stats.
+
+    :param messages: Total number of messages; None if RabbitMQ didn't
+                     report it (see bug 1066338).
+    :param publish_rate: Messages published per second.
+    :param deliver_rate: Messages delivered or fetched per second.
+    :param message_bytes: Total size of the messages, in bytes.
+    :param message_bytes_ram: Size of the messages held in RAM, in bytes.
+    :param memory: Memory used by the queue's process, in bytes.
+    """
+
+    __slots__ = ('name', 'vhost', 'messages', 'messages_ready', 'durable',
+                 'consumers', 'publish_rate',
+                 'deliver_rate') + RESOURCE_METRICS
+
+    # Columns of the management API's queue listing needed by from_api().
+    COLUMNS = ('name', 'vhost', 'messages', 'messages_ready', 'durable',
+               'consumers', 'message_stats.publish_details.rate',
+               'message_stats.deliver_get_details.rate') + RESOURCE_METRICS
+
+    def __init__(self, name, vhost='/', messages=None, messages_ready=None,
+                 durable=False, consumers=0, publish_rate=0.0,
+                 deliver_rate=0.0, message_bytes=None,
+                 message_bytes_ram=None, memory=None):
+        self.name = name
+        self.vhost = vhost
+        self.messages = messages
+        self.messages_ready = messages_ready
+        self.durable = durable
+        self.consumers = consumers
+        self.publish_rate = publish_rate
+        self.deliver_rate = deliver_rate
+        self.message_bytes = message_bytes
+        self.message_bytes_ram = message_bytes_ram
+        self.memory = memory
+
+    @classmethod
+    def from_api(cls, data):
+        """Builds a snapshot from a queue dict returned by the management
+        API.
+        """
+        stats = data.get('message_stats') or {}
+        return cls(name=data['name'],
+                   vhost=data.get('vhost', '/'),
+                   messages=data.get('messages'),
+                   messages_ready=data.get('messages_ready'),
+                   durable=data.get('durable', False),
+                   consumers=data.get('consumers', 0),
+                   publish_rate=_rate(stats, 'publish_details'),
+                   deliver_rate=_rate(stats, 'deliver_get_details'),
+                   message_bytes=data.get('message_bytes'),
+                   message_bytes_ram=data.get('message_bytes_ram'),
+                   memory=data.get('memory'))
+
+    @classmethod
+    def coerce(cls, queue):
+        """Returns queue as a snapshot, building one if it's a dict."""
+        if isinstance(queue, cls):
+            return queue
+        return cls.from_api(queue)
+
+    @property
+    def key(self):
+        """The (vhost, name) identifying the queue."""
+        return (self.vhost, self.name)
+
+    @property
+    def growth_rate(self):
+        """Net number of messages added to the queue per second."""
+        return self.publish_rate - self.deliver_rate
+
+    def __eq__(self, other):
+        if not isinstance(other, QueueSnapshot):
+            return NotImplemented
+        return all(getattr(self, field) == getattr(other, field)
+                   for field in self.__slots__)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    # Snapshots are mutable.
+    __hash__ = None
+
+    def __repr__(self):
+        return "<QueueSnapshot(name='{0}', vhost='{1}', messages={2})>".format(
+            self.name, self.vhost, self.messages)
+
+    __str__ = __repr__
+
+
+def _rate(stats, key):
+    details = stats.get(key)
+    if not details:
+        return 0.0
+    return details.get('rate') or 0.0
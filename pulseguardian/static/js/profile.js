@@ -53,8 +53,14 @@ $(document).ready(function() {
 
     function deleteableObject(objectType) {
         function deleteObject(objectInstance, objectName) {
+            var url = '/' + objectType + '/' + objectName;
+            // Queues are only unique within their vhost.
+            var vhost = $(objectInstance).data(objectType + '-vhost');
+            if (vhost !== undefined) {
+                url += '?vhost=' + encodeURIComponent(vhost);
+            }
             $.ajax({
-                url: '/' + objectType + '/' + objectName,
+                url: url,
                 type: 'DELETE',
                 success: function(result) {
                     if (!result.ok) {
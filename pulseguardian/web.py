@@ -237,12 +237,15 @@ def queues_listing():
 @app.route('/queue/<path:queue_name>', methods=['DELETE'])
 @requires_login
 def delete_queue(queue_name):
-    queue = Queue.query.get(queue_name)
+    vhost = request.values.get('vhost', '/')
+    queue = Queue.query.filter(Queue.vhost==vhost,
+                               Queue.name==queue_name).first()
 
     if queue and (g.user.admin or
                   (queue.owner and queue.owner.owner == g.user)):
         try:
-            pulse_management.delete_queue(vhost='/', queue=queue.name)
+            pulse_management.delete_queue(vhost=queue.vhost,
+                                          queue=queue.name)
         except PulseManagementException as e:
             logging.warning("Couldn't delete the queue '{0}' on "
                                "rabbitmq: {1}".format(queue_name, e))
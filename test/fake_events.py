@@ -0,0 +1,76 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Local stand-in for the queue events of RabbitMQ's event exchange, with
+the interface of pulseguardian.events.AmqpEventSource.
+"""
+
+import threading
+import time
+
+from pulseguardian.events import QUEUE_CREATED, QUEUE_DELETED, QueueEvent
+
+
+class FakeEventSourceError(IOError):
+    pass
+
+
+class FakeEventSourceStopped(Exception):
+    """Raised by drain() once stop() was called, to end a guardian loop."""
+
+
+class FakeEventSource(object):
+
+    exception = FakeEventSourceError
+
+    def __init__(self):
+        self._events = []
+        self._cond = threading.Condition()
+        self._failures = 0
+        self._stopped = False
+        self.closed = False
+
+    def publish(self, event_type, name, vhost='/', durable=False):
+        with self._cond:
+            self._events.append(QueueEvent(event_type, name, vhost, durable))
+            self._cond.notify()
+
+    def created(self, name, vhost='/', durable=False):
+        self.publish(QUEUE_CREATED, name, vhost, durable)
+
+    def deleted(self, name, vhost='/'):
+        self.publish(QUEUE_DELETED, name, vhost)
+
+    def fail(self, times=1):
+        """Makes the next calls to drain() fail, as if the connection to
+        the broker was lost, dropping the events published meanwhile.
+        """
+        with self._cond:
+            self._failures += times
+            self._cond.notify()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    def drain(self, timeout):
+        deadline = time.time() + timeout
+        with self._cond:
+            while not (self._events or self._failures or self._stopped):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            if self._stopped:
+                raise FakeEventSourceStopped()
+            if self._failures:
+                self._failures -= 1
+                self._events = []
+                raise FakeEventSourceError("Connection lost.")
+            events, self._events = self._events, []
+            return events
+
+    def close(self):
+        self.closed = True
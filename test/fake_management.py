@@ -0,0 +1,174 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Local stand-in for the RabbitMQ management plugin's REST API, serving an
+in-memory list of queues.  Only the parts used by PulseGuardian are
+implemented.
+"""
+
+import json
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from urllib import unquote
+from urlparse import parse_qs, urlparse
+
+
+def _project(queue_data, columns):
+    projected = {}
+    for column in columns:
+        value = queue_data
+        for key in column.split('.'):
+            if not isinstance(value, dict) or key not in value:
+                break
+            value = value[key]
+        else:
+            target = projected
+            keys = column.split('.')
+            for key in keys[:-1]:
+                target = target.setdefault(key, {})
+            target[keys[-1]] = value
+    return projected
+
+
+class FakeManagementHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, data=None):
+        body = json.dumps(data) if data is not None else ''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _route(self):
+        url = urlparse(self.path)
+        parts = [unquote(p) for p in url.path.split('/') if p]
+        if parts and parts[0] == 'api':
+            parts = parts[1:]
+        return parts, parse_qs(url.query)
+
+    def do_GET(self):
+        server = self.server
+        parts, query = self._route()
+        server.requests.append(('GET', parts, query))
+
+        if parts[:1] == ['queues'] and len(parts) <= 2:
+            if server.unauthorized:
+                return self._reply(401, dict(error='not_authorised',
+                                             reason='Login failed'))
+            queues = [q for q in server.queues
+                      if len(parts) == 1 or q['vhost'] == parts[1]]
+            if 'columns' in query:
+                columns = query['columns'][0].split(',')
+                queues = [_project(q, columns) for q in queues]
+            if server.stall:
+                # Send half of the listing, then nothing.
+                body = json.dumps(queues)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body[:len(body) // 2])
+                self.wfile.flush()
+                time.sleep(server.stall)
+                return
+            if 'page' in query:
+                page = int(query['page'][0])
+                if page in server.error_pages:
+                    return self._reply(500, dict(error='Internal Error',
+                                                 reason='"Failed"\n'))
+                page_size = int(query.get('page_size', ['100'])[0])
+                queues.sort(key=lambda q: q.get('name'))
+                page_count = max(1, -(-len(queues) // page_size))
+                items = queues[(page - 1) * page_size:page * page_size]
+                return self._reply(200, dict(items=items, page=page,
+                                             page_size=page_size,
+                                             page_count=page_count,
+                                             total_count=len(queues)))
+            return self._reply(200, queues)
+
+        if parts == ['vhosts']:
+            if server.unauthorized:
+                return self._reply(401, dict(error='not_authorised',
+                                             reason='Login failed'))
+            vhosts = sorted(set(['/']) |
+                            set(q['vhost'] for q in server.queues))
+            return self._reply(200, [dict(name=vhost) for vhost in vhosts])
+
+        if parts[:1] == ['bindings'] and len(parts) <= 2:
+            bindings = [b for b in server.bindings
+                        if len(parts) == 1 or b['vhost'] == parts[1]]
+            return self._reply(200, bindings)
+
+        if parts[:1] == ['queues'] and len(parts) == 3:
+            for queue_data in server.queues:
+                if (queue_data['vhost'], queue_data['name']) == (parts[1],
+                                                                 parts[2]):
+                    return self._reply(200, queue_data)
+
+        self._reply(404, dict(error='Object Not Found',
+                              reason='"Not Found"\n'))
+
+    def do_DELETE(self):
+        server = self.server
+        parts, query = self._route()
+        server.requests.append(('DELETE', parts, query))
+
+        if parts[:1] == ['queues'] and len(parts) == 3:
+            # Requests are handled concurrently.
+            with server.lock:
+                remaining = [q for q in server.queues
+                             if (q['vhost'], q['name']) != (parts[1],
+                                                            parts[2])]
+                found = len(remaining) < len(server.queues)
+                server.queues[:] = remaining
+            if found:
+                return self._reply(204)
+
+        self._reply(404, dict(error='Object Not Found',
+                              reason='"Not Found"\n'))
+
+
+class FakeManagementServer(ThreadingMixIn, HTTPServer):
+    """Serves a fake management API on a random local port, in a
+    background thread.
+
+    :param queues: List of queue dicts, as returned by the real API.
+    :param bindings: List of binding dicts, as returned by the real API.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, queues=None, bindings=None):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FakeManagementHandler)
+        self.queues = queues if queues is not None else []
+        self.bindings = bindings if bindings is not None else []
+        self.requests = []
+        self.lock = threading.Lock()
+        # Pages of the queue listing answered with an error.
+        self.error_pages = set()
+        # Whether the listings of vhosts and queues are refused, as after
+        # a password change.
+        self.unauthorized = False
+        # Seconds the queue listing stalls for, halfway; 0 not to stall.
+        self.stall = 0
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}/api'.format(self.server_address[1])
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
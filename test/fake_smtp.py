@@ -0,0 +1,56 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Local stand-in for smtplib.SMTP, recording the connections made and the
+messages sent, and able to drop or refuse connections.
+"""
+
+import errno
+import smtplib
+import socket
+
+
+class FakeSMTP(object):
+
+    # Connections made so far, including refused ones.
+    attempts = 0
+    connections = []
+    # Number of connections accepted before the others are refused; None
+    # for no limit.
+    max_connections = None
+    # Number of messages after which a connection is dropped by the
+    # server; None for no limit.
+    drop_after = None
+
+    @classmethod
+    def reset(cls):
+        cls.attempts = 0
+        cls.connections = []
+        cls.max_connections = None
+        cls.drop_after = None
+
+    def __init__(self, host, port, timeout=None):
+        FakeSMTP.attempts += 1
+        if (self.max_connections is not None and
+                len(self.connections) >= self.max_connections):
+            raise socket.error(errno.ECONNREFUSED, 'Connection refused')
+        self.sent = []
+        self.closed = False
+        FakeSMTP.connections.append(self)
+
+    def login(self, username, password):
+        pass
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        if self.closed or (self.drop_after is not None and
+                           len(self.sent) >= self.drop_after):
+            raise smtplib.SMTPServerDisconnected('Connection unexpectedly '
+                                                 'closed')
+        self.sent.append((from_addr, to_addrs, msg))
+
+    def quit(self):
+        self.closed = True
+
+    def close(self):
+        self.closed = True
@@ -3,18 +3,22 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import base64
+import datetime
 import errno
 import logging
 import multiprocessing
 import os
+import smtplib
 import socket
 import sys
+import threading
 import time
 import unittest
 import uuid
 from urlparse import urlparse
 
 from mozillapulse import consumers, publishers
+from sqlalchemy import event
 from mozillapulse.messages.test import TestMessage
 
 os.environ['FLASK_SECRET_KEY'] = base64.b64encode(os.urandom(24))
@@ -23,17 +27,35 @@ from pulseguardian import config
 # Changing the DB for the tests before the model is initialized
 config.database_url = 'sqlite:///pulseguardian_test.db'
 
-from pulseguardian import dbinit
+from pulseguardian import dbinit, jsoncodec
+from pulseguardian.asyncapi import AsyncPulseManagementAPI, wait
+from pulseguardian.bindings import ExchangeResolver
+from pulseguardian.evaluator import ThresholdEvaluator, numpy
 from pulseguardian.guardian import PulseGuardian
-from pulseguardian.management import PulseManagementAPI
-from pulseguardian.model.base import db_session
+from pulseguardian.leader import LeaseElection
+from pulseguardian.management import (CircuitBreaker, PulseManagementAPI,
+                                      PulseManagementException)
+from pulseguardian.model.base import db_session, engine
+from pulseguardian.model.models import (GuardianLease, GuardianWorker,
+                                       ThresholdPolicy)
+from pulseguardian.model.staging import sync_queues
 from pulseguardian.model.pulse_user import PulseUser
 from pulseguardian.model.queue import Queue
 from pulseguardian.model.user import User
+from pulseguardian.notifier import DigestNotifier, Notifier
+from pulseguardian.pipeline import Handoff, SnapshotFetcher
+from pulseguardian.policy import PolicyIndex
+from pulseguardian.scheduler import PollingScheduler
+from pulseguardian.sendemail import SMTPClient, build_message
+from pulseguardian.sharding import HashRing, ShardCoordinator
+from pulseguardian.snapshot import QueueSnapshot
 
 from docker_setup import (
     create_image, setup_container, teardown_container, check_rabbitmq
 )
+from fake_events import FakeEventSource, FakeEventSourceStopped
+from fake_management import FakeManagementServer
+from fake_smtp import FakeSMTP
 
 # Default RabbitMQ host settings
 DEFAULT_RABBIT_HOST = 'localhost'
@@ -390,6 +412,1083 @@ class ModelTest(unittest.TestCase):
             None)
 
 
+class ManagementAPITest(unittest.TestCase):
+
+    """Tests the management API wrapper against a local stand-in of the
+    management plugin.
+    """
+
+    def setUp(self):
+        self.queues = [dict(name='queue/{0}/q{1}'.format(CONSUMER_USER, i),
+                            vhost=DEFAULT_RABBIT_VHOST, messages=i,
+                            messages_ready=i, durable=False,
+                            consumers=0, memory=1024)
+                       for i in xrange(25)]
+        self.server = FakeManagementServer(self.queues).start()
+        self.management_api = PulseManagementAPI(
+            management_url=self.server.url, user='guest', password='guest')
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.2)
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.assertFalse(breaker.is_open)
+        breaker.failure()
+        self.assertTrue(breaker.is_open)
+        self.assertFalse(breaker.allow())
+
+        # A single trial call is let through after the timeout...
+        time.sleep(0.2)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        # ... and closes the breaker when it succeeds.
+        breaker.success()
+        self.assertFalse(breaker.is_open)
+        self.assertTrue(breaker.allow())
+
+    def test_unreachable_api(self):
+        # Nothing listens on port 1.
+        breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60)
+        api = PulseManagementAPI(management_url='http://127.0.0.1:1/api',
+                                 user='guest', password='guest',
+                                 backoff_base=0.01, breaker=breaker)
+        self.assertRaises(PulseManagementException, api.queues)
+        self.assertTrue(breaker.is_open)
+
+        # Further calls fail right away while the breaker is open.
+        start = time.time()
+        self.assertRaises(PulseManagementException, api.queues)
+        self.assertTrue(time.time() - start < 0.1)
+
+    def test_cluster_failover(self):
+        # Nodes of a cluster serve the same queues.
+        other = FakeManagementServer(self.queues).start()
+        try:
+            api = PulseManagementAPI(
+                management_url='http://127.0.0.1:1/api,{0},{1}'.format(
+                    self.server.url, other.url),
+                user='guest', password='guest', backoff_base=0.01)
+            dead = api.nodes[0]
+            for i in xrange(5):
+                self.assertEqual(len(api.queues()), len(self.queues))
+            # The node that can't be reached was only tried once.
+            self.assertFalse(dead.healthy)
+            self.assertEqual(dead.breaker.failures, 1)
+            self.assertEqual(len(self.server.requests) +
+                             len(other.requests), 5)
+            self.assertEqual(api.available_nodes(), sorted(
+                api.nodes[1:], key=lambda node: node.latency))
+
+            # Per-vhost listings are spread over the healthy nodes.
+            before = [len(server.requests) for server in (self.server, other)]
+            async_api = AsyncPulseManagementAPI(api)
+            try:
+                listings = list(async_api.vhost_snapshots(
+                    [DEFAULT_RABBIT_VHOST, 'a', 'b', 'c']))
+            finally:
+                async_api.close()
+            self.assertEqual(len(listings), 4)
+            self.assertTrue(all(error is None
+                                for vhost, queues, error in listings))
+            self.assertEqual([len(server.requests) - count for server, count
+                              in zip((self.server, other), before)], [2, 2])
+        finally:
+            other.stop()
+
+    def test_queue_columns(self):
+        queues = self.management_api.queues(
+            columns=('name', 'messages'))
+        self.assertEqual(len(queues), len(self.queues))
+        self.assertEqual(set(queues[0]), set(['name', 'messages']))
+
+    def test_queue_pages(self):
+        queues = list(self.management_api.iter_queues(
+            columns=('name', 'messages'), page_size=10))
+        self.assertEqual(sorted(q['name'] for q in queues),
+                         sorted(q['name'] for q in self.queues))
+        pages = [r for r in self.server.requests if r[0] == 'GET']
+        self.assertEqual(len(pages), 3)
+
+        # A page that fails ends the listing with an error.
+        self.server.error_pages.add(2)
+        self.assertRaises(PulseManagementException, list,
+                          self.management_api.iter_queues(page_size=10))
+
+    def test_delete_all_queues(self):
+        # An error listing the queues isn't taken for an empty listing.
+        self.server.unauthorized = True
+        self.assertRaises(PulseManagementException,
+                          self.management_api.delete_all_queues)
+        self.server.unauthorized = False
+        self.management_api.delete_all_queues()
+        self.assertEqual(self.server.queues, [])
+
+    def test_exchange_resolver(self):
+        self.server.bindings.extend([
+            dict(source='', vhost=DEFAULT_RABBIT_VHOST,
+                 destination=self.queues[0]['name'],
+                 destination_type='queue'),
+            dict(source='exchange/test', vhost=DEFAULT_RABBIT_VHOST,
+                 destination=self.queues[0]['name'],
+                 destination_type='queue')])
+        resolver = ExchangeResolver(self.management_api, ttl=60)
+        for queue_data in self.queues:
+            resolver.exchange(DEFAULT_RABBIT_VHOST, queue_data['name'])
+        self.assertEqual(resolver.exchange(DEFAULT_RABBIT_VHOST,
+                                           self.queues[0]['name']),
+                         'exchange/test')
+        self.assertEqual(resolver.exchange(DEFAULT_RABBIT_VHOST,
+                                           self.queues[1]['name']), None)
+
+        # The bindings were only fetched once.
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_async_api(self):
+        async_api = AsyncPulseManagementAPI(self.management_api)
+        try:
+            snapshots = async_api.queue_snapshots()
+            queue = async_api.queue(DEFAULT_RABBIT_VHOST,
+                                    self.queues[3]['name'])
+            missing = async_api.queue(DEFAULT_RABBIT_VHOST, 'missing')
+            self.assertEqual([q.name for q in wait(snapshots)],
+                             [q['name'] for q in self.queues])
+            self.assertEqual(wait(queue)['messages'], 3)
+            self.assertTrue('error' in wait(missing))
+
+            # Exceptions are raised by wait().
+            unreachable = AsyncPulseManagementAPI(PulseManagementAPI(
+                management_url='http://127.0.0.1:1/api', user='guest',
+                password='guest', max_retry=1))
+            self.assertRaises(PulseManagementException, wait,
+                              unreachable.queue_snapshots())
+            unreachable.close()
+        finally:
+            async_api.close()
+
+    def test_snapshot_fetcher(self):
+        handoff = Handoff(size=1)
+        fetcher = SnapshotFetcher(self.management_api.queue_snapshots,
+                                  handoff, interval=0.05,
+                                  exception=PulseManagementException)
+        fetcher.start()
+        time.sleep(0.3)
+        fetcher.stop()
+
+        # Only the latest listing was kept.
+        fetched_at, queues = handoff.get(timeout=0)
+        self.assertTrue(handoff.dropped > 0)
+        self.assertEqual(handoff.get(timeout=0), None)
+        self.assertEqual([q.name for q in queues],
+                         [q['name'] for q in self.queues])
+        self.assertTrue(time.time() - fetched_at < 0.2)
+
+    def test_delete_queues(self):
+        doomed = [(DEFAULT_RABBIT_VHOST, q['name']) for q in self.queues[:10]]
+        doomed.append((DEFAULT_RABBIT_VHOST, 'missing'))
+        results = self.management_api.delete_queues(doomed)
+
+        self.assertEqual([item for item, error in results], doomed)
+        errors = [item for item, error in results if error is not None]
+        self.assertEqual(errors, [(DEFAULT_RABBIT_VHOST, 'missing')])
+        self.assertEqual(len(self.server.queues), 15)
+
+    def test_stream_queues(self):
+        queues = self.management_api.stream_queues(columns=('name',))
+        self.assertEqual([q['name'] for q in queues],
+                         [q['name'] for q in self.queues])
+
+        # Without ijson, the standard library's decoder is used.
+        ijson, jsoncodec._ijson = jsoncodec._ijson, None
+        try:
+            queues = self.management_api.stream_queues(columns=('name',))
+            self.assertEqual([q['name'] for q in queues],
+                             [q['name'] for q in self.queues])
+        finally:
+            jsoncodec._ijson = ijson
+
+    def test_stalled_stream(self):
+        self.server.stall = 2
+        api = PulseManagementAPI(management_url=self.server.url,
+                                 user='guest', password='guest',
+                                 read_timeout=0.2)
+        # With ijson (if installed), then with the standard library.
+        ijson = jsoncodec._ijson
+        try:
+            for backend in set([ijson, None]):
+                jsoncodec._ijson = backend
+                self.assertRaises(PulseManagementException, list,
+                                  api.stream_queues())
+        finally:
+            jsoncodec._ijson = ijson
+
+    @unittest.skipIf(jsoncodec._ijson is None, 'ijson is not installed')
+    def test_stream_rates(self):
+        # ijson decodes non-integer numbers as Decimals.
+        self.queues[0]['message_stats'] = dict(
+            publish_details=dict(rate=2.5),
+            deliver_get_details=dict(rate=0.5))
+        queue = next(self.management_api.queue_snapshots(stream=True))
+        self.assertIsInstance(queue.publish_rate, float)
+        self.assertEqual(queue.growth_rate, 2.0)
+
+
+class NotifierTest(unittest.TestCase):
+
+    """Tests the background delivery of notifications."""
+
+    def setUp(self):
+        self.sent = []
+
+    def _slow_send(self, notification):
+        time.sleep(0.1)
+        self.sent.append(notification)
+
+    def test_notify(self):
+        notifier = Notifier(workers=2, max_pending=10, send=self._slow_send)
+        start = time.time()
+        for i in xrange(4):
+            self.assertTrue(notifier.notify('subject {0}'.format(i), 'body',
+                                            [CONSUMER_EMAIL]))
+        # Queueing doesn't wait for the deliveries.
+        self.assertTrue(time.time() - start < 0.1)
+
+        self.assertTrue(notifier.flush(timeout=5))
+        self.assertEqual(len(self.sent), 4)
+        metrics = notifier.metrics()
+        self.assertEqual(metrics['sent'], 4)
+        self.assertEqual(metrics['pending'], 0)
+        notifier.shutdown()
+
+    def test_full_queue(self):
+        notifier = Notifier(workers=1, max_pending=1, send=self._slow_send)
+        results = [notifier.notify('subject', 'body', [CONSUMER_EMAIL])
+                   for i in xrange(5)]
+        self.assertFalse(all(results))
+        notifier.shutdown()
+        self.assertEqual(notifier.metrics()['dropped'],
+                         results.count(False))
+
+    def test_digest(self):
+        notifier = DigestNotifier(Notifier(send=self.sent.append),
+                                  window=0.2)
+        other_email = 'other@guardtest.com'
+        for i in xrange(3):
+            notifier.notify('subject {0}'.format(i), 'body',
+                            [CONSUMER_EMAIL, other_email])
+        notifier.notify('lonely', 'body', [other_email])
+        notifier.notify('single', 'body', ['single@guardtest.com'])
+        self.assertEqual(notifier.metrics()['held'], 8)
+
+        time.sleep(0.5)
+        notifier.shutdown()
+
+        # One email per recipient, whatever the number of notifications.
+        self.assertEqual(sorted(n.to_addrs[0] for n in self.sent),
+                         sorted([CONSUMER_EMAIL, other_email,
+                                 'single@guardtest.com']))
+        by_address = dict((n.to_addrs[0], n) for n in self.sent)
+        self.assertTrue('3 notifications' in
+                        by_address[CONSUMER_EMAIL].subject)
+        self.assertTrue('in the last 0.2 seconds.' in
+                        by_address[CONSUMER_EMAIL].body)
+        self.assertTrue('lonely' in by_address[other_email].body)
+        self.assertEqual(by_address['single@guardtest.com'].subject,
+                         'single')
+
+
+class SMTPClientTest(unittest.TestCase):
+
+    """Tests the persistent SMTP connection against a stand-in of
+    smtplib.SMTP.
+    """
+
+    def setUp(self):
+        FakeSMTP.reset()
+        self.smtp = smtplib.SMTP
+        smtplib.SMTP = FakeSMTP
+        self.msg = build_message(from_addr='guardian@guardtest.com',
+                                 to_addrs=[CONSUMER_EMAIL],
+                                 text_data='body')
+
+    def tearDown(self):
+        smtplib.SMTP = self.smtp
+
+    def _messages(self, count):
+        return [('guardian@guardtest.com', [CONSUMER_EMAIL], self.msg)
+                for i in xrange(count)]
+
+    def test_reconnect(self):
+        FakeSMTP.drop_after = 1
+        client = SMTPClient()
+        client.send('guardian@guardtest.com', [CONSUMER_EMAIL], self.msg)
+        client.send('guardian@guardtest.com', [CONSUMER_EMAIL], self.msg)
+        first, second = FakeSMTP.connections
+        # The dropped connection was closed before reconnecting.
+        self.assertTrue(first.closed)
+        self.assertEqual((len(first.sent), len(second.sent)), (1, 1))
+        client.close()
+
+    def test_max_messages(self):
+        with SMTPClient(max_messages=2) as client:
+            self.assertEqual(client.send_many(self._messages(5)),
+                             [None] * 5)
+        self.assertEqual([len(c.sent) for c in FakeSMTP.connections],
+                         [2, 2, 1])
+        self.assertTrue(all(c.closed for c in FakeSMTP.connections))
+
+    def test_lost_connection(self):
+        FakeSMTP.drop_after = 1
+        FakeSMTP.max_connections = 1
+        with SMTPClient() as client:
+            results = client.send_many(self._messages(4))
+        self.assertEqual(results[0], None)
+        self.assertTrue(all(isinstance(e, socket.error)
+                            for e in results[1:]))
+        # The remaining messages failed without reconnecting again.
+        self.assertEqual(FakeSMTP.attempts, 2)
+
+
+class ThresholdEvaluatorTest(unittest.TestCase):
+
+    sizes = [10, 150, 300, None, 150, 10, 10, 90, 150]
+    rates = [0, 0, 0, 0, 0, 0, 100.0, 10.0, 0]
+    warned = [False, False, False, True, True, True, False, False, True]
+
+    def _evaluate(self, use_numpy):
+        evaluator = ThresholdEvaluator(warn_queue_size=100,
+                                       del_queue_size=200, warn_horizon=20,
+                                       del_horizon=5, use_numpy=use_numpy)
+        return evaluator.evaluate(self.sizes, self.rates, self.warned)
+
+    def test_array_evaluation(self):
+        evaluation = self._evaluate(use_numpy=False)
+        # The queue over the threshold comes before the one projected to
+        # reach it in 1.9s.
+        self.assertEqual(evaluation.delete, [2, 6])
+        self.assertEqual(evaluation.warn, [7, 1])
+        self.assertEqual(evaluation.normal, [5])
+        self.assertEqual(evaluation.rest, [0, 3, 4, 8])
+
+    def test_unset_warned_flags(self):
+        # Records never warned have no flag.
+        evaluator = ThresholdEvaluator(warn_queue_size=100,
+                                       del_queue_size=200, use_numpy=False)
+        evaluation = evaluator.evaluate([10, 150, 300], [0, 0, 0],
+                                        [None, None, True])
+        self.assertEqual(evaluation.delete, [2])
+        self.assertEqual(evaluation.warn, [1])
+        self.assertEqual(evaluation.rest, [0])
+
+    @unittest.skipIf(numpy is None, 'NumPy is not installed')
+    def test_numpy_evaluation(self):
+        self.assertEqual(self._evaluate(use_numpy=True),
+                         self._evaluate(use_numpy=False))
+
+    def test_usage_limits(self):
+        # Small queues using a lot of memory, the second one over the
+        # deletion limit; the last one's usage is unknown.
+        usages = {'message_bytes': [10, 5000, 100000, None]}
+        for use_numpy in filter(None, [numpy is not None]) + [False]:
+            evaluator = ThresholdEvaluator(
+                warn_queue_size=100, del_queue_size=200,
+                limits={'message_bytes': (1000, 10000), 'memory': (0, 0)},
+                use_numpy=use_numpy)
+            self.assertEqual(evaluator.limits.keys(), ['message_bytes'])
+            evaluation = evaluator.evaluate([10, 10, 10, 10], [0] * 4,
+                                            [False] * 4, usages=usages)
+            self.assertEqual(evaluation.delete, [2])
+            self.assertEqual(evaluation.warn, [1])
+            self.assertEqual(evaluation.rest, [0, 3])
+
+
+class PolicyIndexTest(unittest.TestCase):
+
+    def test_resolve(self):
+        owner = PulseUser(username='carol')
+        policies = [
+            ThresholdPolicy(kind=ThresholdPolicy.QUEUE,
+                            pattern='queue/alice/exact', del_queue_size=50),
+            ThresholdPolicy(kind=ThresholdPolicy.PREFIX,
+                            pattern='queue/alice/', warn_queue_size=10,
+                            del_queue_size=20),
+            ThresholdPolicy(kind=ThresholdPolicy.PREFIX,
+                            pattern='queue/alice/big', warn_queue_size=1000,
+                            del_queue_size=2000),
+            ThresholdPolicy(kind=ThresholdPolicy.REGEX, pattern='.*/tmp-',
+                            rank=2, warn_queue_size=1, del_queue_size=2),
+            ThresholdPolicy(kind=ThresholdPolicy.REGEX, pattern='.*/tmp-b',
+                            rank=1, warn_queue_size=3, del_queue_size=4),
+            ThresholdPolicy(kind=ThresholdPolicy.REGEX, pattern='(',
+                            warn_queue_size=5, del_queue_size=6),
+            ThresholdPolicy(kind=ThresholdPolicy.OWNER, owner=owner,
+                            warn_queue_size=30, del_queue_size=40)]
+        index = PolicyIndex(policies, (100, 200),
+                            PulseGuardian.queue_owner_name)
+
+        self.assertEqual(index.resolve('queue/alice/exact'), (100, 50))
+        self.assertEqual(index.resolve('queue/alice/q'), (10, 20))
+        self.assertEqual(index.resolve('queue/alice/bigger'), (1000, 2000))
+        self.assertEqual(index.resolve('queue/bob/tmp-a'), (1, 2))
+        self.assertEqual(index.resolve('queue/bob/tmp-b'), (3, 4))
+        self.assertEqual(index.resolve('queue/carol/q'), (30, 40))
+        self.assertEqual(index.resolve('queue/bob/q'), (100, 200))
+        self.assertEqual(index.resolve('queue/alicex/q'), (100, 200))
+        # The invalid regular expression was ignored.
+        self.assertEqual(len(index.regexes), 2)
+
+    def test_invalid_thresholds(self):
+        policies = [
+            ThresholdPolicy(kind=ThresholdPolicy.QUEUE,
+                            pattern='queue/alice/q', warn_queue_size=-1),
+            ThresholdPolicy(kind=ThresholdPolicy.PREFIX,
+                            pattern='queue/alice/', warn_queue_size=50,
+                            del_queue_size=20),
+            ThresholdPolicy(kind=ThresholdPolicy.PREFIX,
+                            pattern='queue/bob/', warn_queue_size=20,
+                            del_queue_size=20)]
+        index = PolicyIndex(policies, (100, 200),
+                            PulseGuardian.queue_owner_name)
+        self.assertEqual(index.resolve('queue/alice/q'), (100, 200))
+        self.assertEqual(index.resolve('queue/alice/r'), (100, 200))
+        self.assertEqual(index.resolve('queue/bob/q'), (20, 20))
+        self.assertEqual(index.exact, {})
+
+    def test_cache_size(self):
+        policy = ThresholdPolicy(kind=ThresholdPolicy.PREFIX,
+                                 pattern='queue/alice/', del_queue_size=20)
+        index = PolicyIndex([policy], (100, 200),
+                            PulseGuardian.queue_owner_name, cache_size=10)
+        for i in xrange(25):
+            self.assertEqual(index.resolve('queue/alice/{0}'.format(i)),
+                             (100, 20))
+        self.assertTrue(len(index._cache) <= 10)
+
+        # Nothing is cached without policies.
+        index = PolicyIndex([], (100, 200), PulseGuardian.queue_owner_name)
+        self.assertEqual(index.resolve('queue/alice/q'), (100, 200))
+        self.assertEqual(index._cache, {})
+
+
+class QueueSnapshotTest(unittest.TestCase):
+
+    def test_from_api(self):
+        data = dict(name='queue/alice/q', vhost='v', messages=10,
+                    messages_ready=8, durable=True, consumers=2,
+                    message_bytes=1000, message_bytes_ram=500, memory=2000,
+                    message_stats=dict(publish_details=dict(rate=5.0),
+                                       deliver_get_details=dict(rate=2.0)),
+                    idle_since='2015-01-01 00:00:00')
+        queue = QueueSnapshot.from_api(data)
+        self.assertEqual(queue, QueueSnapshot(
+            'queue/alice/q', vhost='v', messages=10, messages_ready=8,
+            durable=True, consumers=2, publish_rate=5.0, deliver_rate=2.0,
+            message_bytes=1000, message_bytes_ram=500, memory=2000))
+        self.assertEqual(queue.key, ('v', 'queue/alice/q'))
+        self.assertEqual(queue.growth_rate, 3.0)
+        self.assertTrue(QueueSnapshot.coerce(queue) is queue)
+        self.assertEqual(QueueSnapshot.coerce(data), queue)
+
+        # Missing fields, e.g. on a queue without any activity yet.
+        queue = QueueSnapshot.from_api(dict(name='queue/alice/q'))
+        self.assertEqual(queue, QueueSnapshot('queue/alice/q'))
+        self.assertEqual((queue.vhost, queue.messages, queue.growth_rate),
+                         ('/', None, 0.0))
+
+    def test_equality(self):
+        queue = QueueSnapshot('queue/alice/q', messages=10)
+        self.assertEqual(queue, QueueSnapshot('queue/alice/q', messages=10))
+        self.assertNotEqual(queue, QueueSnapshot('queue/alice/q',
+                                                 messages=11))
+        self.assertNotEqual(queue, QueueSnapshot('queue/alice/q',
+                                                 messages=10, vhost='v'))
+        self.assertNotEqual(queue, queue.key)
+
+    def test_slots(self):
+        queue = QueueSnapshot('queue/alice/q')
+        self.assertFalse(hasattr(queue, '__dict__'))
+        with self.assertRaises(AttributeError):
+            queue.idle_since = None
+
+
+class PollingSchedulerTest(unittest.TestCase):
+
+    def test_backoff(self):
+        scheduler = PollingScheduler(warn_queue_size=100, del_queue_size=200,
+                                     min_interval=1, max_interval=8,
+                                     backoff=2)
+        intervals = []
+        for i in xrange(5):
+            list(scheduler.observe([QueueSnapshot('q', messages=10)]))
+            intervals.append(scheduler.next_interval())
+        self.assertEqual(intervals, [2, 4, 8, 8, 8])
+
+    def test_growing_queue(self):
+        scheduler = PollingScheduler(warn_queue_size=100, del_queue_size=200,
+                                     min_interval=1, max_interval=60)
+        scheduler.interval = 60
+
+        # Each poll lists a different queue, so that only the rates reported
+        # count, not the growth observed between polls.
+        # 90 messages away from the warning threshold at 10 messages/s.
+        list(scheduler.observe([QueueSnapshot('q', messages=10,
+                                              publish_rate=10.0)]))
+        self.assertEqual(scheduler.next_interval(), 4.5)
+
+        # Past it, the deletion threshold is the next one.
+        list(scheduler.observe([QueueSnapshot('q2', messages=110,
+                                              publish_rate=10.0)]))
+        self.assertEqual(scheduler.next_interval(), 4.5)
+
+        # Never sooner than the minimum interval.
+        list(scheduler.observe([QueueSnapshot('q3', messages=199,
+                                              publish_rate=10.0)]))
+        self.assertEqual(scheduler.next_interval(), 1)
+
+    def test_growth_rates(self):
+        scheduler = PollingScheduler(warn_queue_size=100, del_queue_size=200)
+        list(scheduler.observe([QueueSnapshot('q', messages=10),
+                                QueueSnapshot('reported', messages=10,
+                                              publish_rate=2.0,
+                                              deliver_rate=1.0)]))
+        self.assertEqual(scheduler.growth_rate('q'), 0)
+        self.assertEqual(scheduler.growth_rate('reported'), 1.0)
+
+        # Pretend the first poll was 10 seconds ago.
+        scheduler._sizes = dict((key, (messages, observed_at - 10))
+                                for key, (messages, observed_at)
+                                in scheduler._sizes.iteritems())
+        list(scheduler.observe([QueueSnapshot('q', messages=110)]))
+        self.assertAlmostEqual(scheduler.growth_rate('q'), 10, places=2)
+        self.assertEqual(scheduler.growth_rate('reported'), 0)
+
+
+class CycleBudgetTest(unittest.TestCase):
+
+    """Tests the deferral of bookkeeping once a cycle's budget is spent."""
+
+    def setUp(self):
+        dbinit.init_and_clear_db()
+        self.queues = [dict(name='queue/{0}/q{1}'.format(CONSUMER_USER, i),
+                            vhost='/', messages=10, messages_ready=10,
+                            durable=False, consumers=0)
+                       for i in xrange(5)]
+        self.doomed = dict(self.queues[0], name='queue/{0}/big'.format(
+            CONSUMER_USER), messages=500, messages_ready=500)
+        self.server = FakeManagementServer(
+            self.queues + [self.doomed]).start()
+        self.management_api = PulseManagementAPI(
+            management_url=self.server.url, user='guest', password='guest')
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_budget(self):
+        guardian = PulseGuardian(self.management_api, emails=False,
+                                 warn_queue_size=100, del_queue_size=200,
+                                 cycle_budget=1e-6)
+        deleted = guardian.monitor_queues(list(self.server.queues))
+        # The deletion isn't deferred, unlike the bookkeeping.
+        self.assertEqual(deleted, [('/', self.doomed['name'])])
+        self.assertEqual(len(self.server.queues), len(self.queues))
+        keys = set(('/', q['name']) for q in self.queues)
+        self.assertEqual(guardian._pending, keys)
+        self.assertEqual(Queue.query.count(), 0)
+
+        # The deferred queues are reconciled on the next cycle, though they
+        # didn't change.
+        guardian.cycle_budget = 0
+        guardian.monitor_queues(list(self.server.queues))
+        self.assertEqual(guardian._pending, set())
+        self.assertEqual(set(queue.key for queue in Queue.query.all()), keys)
+
+
+class SnapshotTest(unittest.TestCase):
+
+    """Tests the diffing of the queue listings between cycles."""
+
+    def setUp(self):
+        dbinit.init_and_clear_db()
+        self.queue = dict(name='queue/{0}/q'.format(CONSUMER_USER),
+                          vhost='/', messages=10, messages_ready=10,
+                          durable=False, consumers=0, memory=500)
+        self.server = FakeManagementServer([self.queue]).start()
+        self.management_api = PulseManagementAPI(
+            management_url=self.server.url, user='guest', password='guest')
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_diff(self):
+        guardian = PulseGuardian(self.management_api, emails=False,
+                                 warn_queue_size=100, del_queue_size=200)
+        same, resized, vanished, pending = [
+            QueueSnapshot('queue/{0}/{1}'.format(CONSUMER_USER, name),
+                          messages=1)
+            for name in ('same', 'resized', 'vanished', 'pending')]
+        guardian.snapshot = dict((q.key, (1, False, None))
+                                 for q in (same, resized, vanished, pending))
+        guardian._pending = set([pending.key])
+        resized.messages = 2
+        new = QueueSnapshot('queue/{0}/new'.format(CONSUMER_USER),
+                            messages=1)
+        other = QueueSnapshot('queue/{0}/other'.format(CONSUMER_USER),
+                              vhost='other', messages=1)
+        guardian.snapshot[other.key] = (1, False, None)
+
+        changed, gone, live = guardian.diff_snapshot(
+            [same, resized, pending, new], vhost='/')
+        # The unchanged queue is skipped.
+        self.assertEqual(set(q.key for q in changed),
+                         set([resized.key, pending.key, new.key]))
+        self.assertEqual(gone, [vanished.key])
+        self.assertEqual(set(live),
+                         set([same.key, resized.key, pending.key, new.key]))
+        self.assertEqual(live[resized.key], (2, False, None))
+
+        # Without a vhost, the listing covers all of them.
+        changed, gone, live = guardian.diff_snapshot(
+            [same, resized, pending, new])
+        self.assertEqual(set(gone), set([vanished.key, other.key]))
+
+    def test_resync(self):
+        guardian = PulseGuardian(self.management_api, emails=False,
+                                 warn_queue_size=100, del_queue_size=200,
+                                 snapshot_resync_interval=3600)
+        # The first cycle is a full one.
+        self.assertTrue(guardian.begin_cycle())
+        guardian.monitor_queues(list(self.server.queues))
+        queue = Queue.query.one()
+        self.assertEqual(queue.size, 10)
+
+        # The record drifts; the unchanged queue isn't looked at.
+        queue.size = 0
+        db_session.commit()
+        self.assertFalse(guardian.begin_cycle())
+        guardian.monitor_queues(list(self.server.queues))
+        self.assertEqual(Queue.query.one().size, 0)
+
+        # Until the resync interval elapses.
+        guardian._last_resync -= 3600
+        guardian.monitor_queues(list(self.server.queues))
+        self.assertEqual(Queue.query.one().size, 10)
+        self.assertFalse(guardian.begin_cycle())
+
+    def test_bulk_load(self):
+        guardian = PulseGuardian(self.management_api, emails=False,
+                                 warn_queue_size=100, del_queue_size=200)
+        guardian.monitor_queues(list(self.server.queues))
+        self.server.queues.extend(
+            dict(self.queue, name='queue/{0}/q{1}'.format(owner, i))
+            for owner in (CONSUMER_USER, 'other') for i in xrange(3))
+        self.server.queues[0]['messages'] = 20
+
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(engine, 'before_cursor_execute', record)
+        try:
+            guardian.monitor_queues(list(self.server.queues))
+        finally:
+            event.remove(engine, 'before_cursor_execute', record)
+
+        # The changed and new queues' records are loaded in one query.
+        loads = [s for s in statements
+                 if s.startswith('SELECT') and 'FROM queues' in s]
+        self.assertEqual(len(loads), 1)
+        owners = dict((queue.name, queue.owner.username)
+                      for queue in Queue.query.all())
+        self.assertEqual(len(owners), 7)
+        for name, owner in owners.iteritems():
+            self.assertEqual(owner, name.split('/')[1])
+
+    def test_limit_only_change(self):
+        guardian = PulseGuardian(self.management_api, emails=False,
+                                 warn_queue_size=100, del_queue_size=200,
+                                 limits={'memory': (0, 1000)})
+        self.assertEqual(guardian.monitor_queues(list(self.server.queues)),
+                         [])
+        key = ('/', self.queue['name'])
+        self.assertEqual(guardian.snapshot, {key: (10, False, None)})
+
+        # Only the memory used by the queue changes, over its deletion
+        # limit.
+        self.server.queues[0]['memory'] = 5000
+        self.assertEqual(guardian.monitor_queues(list(self.server.queues)),
+                         [key])
+        self.assertEqual(self.server.queues, [])
+
+    def test_failed_cycle(self):
+        guardian = PulseGuardian(self.management_api, emails=False,
+                                 warn_queue_size=100, del_queue_size=200)
+        update_queue_information = guardian.update_queue_information
+
+        def failing_update(*args):
+            update_queue_information(*args)
+            raise RuntimeError('failed')
+
+        # Nothing is committed, and the queue is looked at again on the
+        # next cycle.
+        guardian.update_queue_information = failing_update
+        with self.assertRaises(RuntimeError):
+            guardian.monitor_queues(list(self.server.queues))
+        self.assertEqual(Queue.query.count(), 0)
+        self.assertEqual(guardian.snapshot, {})
+
+        guardian.update_queue_information = update_queue_information
+        guardian.monitor_queues(list(self.server.queues))
+        self.assertEqual([queue.name for queue in Queue.query.all()],
+                         [self.queue['name']])
+
+
+class EventTrackingTest(unittest.TestCase):
+
+    """Tests the tracking of queues from RabbitMQ's queue events, using a
+    local stand-in of the event source.
+    """
+
+    def setUp(self):
+        dbinit.init_and_clear_db()
+        self.server = FakeManagementServer().start()
+        self.management_api = PulseManagementAPI(
+            management_url=self.server.url, user='guest', password='guest')
+        self.source = FakeEventSource()
+        scheduler = PollingScheduler(100, 200, min_interval=0.1,
+                                     max_interval=0.1)
+        self.guardian = PulseGuardian(self.management_api, emails=False,
+                                      warn_queue_size=100,
+                                      del_queue_size=200,
+                                      scheduler=scheduler)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def _queue_names(self):
+        # End the current transaction to see other threads' changes.
+        db_session.rollback()
+        return set(queue.name for queue in Queue.query.all())
+
+    def _wait_for(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition():
+            if time.time() > deadline:
+                self.fail("Timed out.")
+            time.sleep(0.05)
+
+    def test_apply_events(self):
+        name = 'queue/{0}/q'.format(CONSUMER_USER)
+        self.source.created(name, durable=True)
+        self.source.created('temporary')
+        self.source.deleted('temporary')
+        self.source.created('other')
+        self.guardian.apply_events(self.source.drain(0))
+
+        self.assertEqual(self._queue_names(), set([name, 'other']))
+        queue = Queue.query.filter(Queue.name == name).first()
+        self.assertEqual(queue.owner.username, CONSUMER_USER)
+        self.assertEqual(queue.size, 0)
+        self.assertTrue(queue.durable)
+        self.assertEqual(self.guardian.snapshot,
+                         {('/', name): (0, True, None),
+                          ('/', 'other'): (0, False, None)})
+
+        self.source.deleted(name)
+        self.guardian.apply_events(self.source.drain(0))
+        self.assertEqual(self._queue_names(), set(['other']))
+        self.assertEqual(self.guardian.snapshot,
+                         {('/', 'other'): (0, False, None)})
+
+    def test_guard_events(self):
+        def run():
+            try:
+                self.guardian.guard_events(self.source, repair_interval=3600)
+            except FakeEventSourceStopped:
+                pass
+        repaired = threading.Event()
+        clear_deleted_queues = self.guardian.clear_deleted_queues
+
+        def clear_and_signal(*args):
+            clear_deleted_queues(*args)
+            repaired.set()
+        self.guardian.clear_deleted_queues = clear_and_signal
+
+        guard = threading.Thread(target=run)
+        guard.start()
+        try:
+            # Wait for the repair of the first cycle.
+            self.assertTrue(repaired.wait(5))
+            name = 'queue/{0}/q'.format(CONSUMER_USER)
+            self.server.queues.append(dict(name=name, vhost='/',
+                                           messages=0, messages_ready=0,
+                                           durable=False, consumers=0))
+            self.source.created(name)
+            self._wait_for(lambda: name in self._queue_names())
+
+            # Records missed by the snapshot are only repaired after events
+            # may have been lost.
+            db_session.add(Queue(name='stale', size=0))
+            db_session.commit()
+            time.sleep(0.3)
+            self.assertIn('stale', self._queue_names())
+            self.source.fail()
+            self._wait_for(lambda: 'stale' not in self._queue_names())
+            self.assertIn(name, self._queue_names())
+        finally:
+            self.source.stop()
+            guard.join(5)
+        self.assertTrue(self.source.closed)
+
+
+class ShardingTest(unittest.TestCase):
+
+    """Tests the splitting of the queues between guardian workers."""
+
+    names = ['queue/{0}/q{1}'.format(CONSUMER_USER, i) for i in xrange(300)]
+
+    def setUp(self):
+        dbinit.init_and_clear_db()
+        GuardianWorker.query.delete()
+        db_session.commit()
+
+    def test_hash_ring(self):
+        ring = HashRing(['a', 'b', 'c'])
+        owners = dict((name, ring.owner(name)) for name in self.names)
+        for worker in 'abc':
+            self.assertGreater(owners.values().count(worker), 50)
+
+        # Only the queues of the worker that left change hands.
+        ring = HashRing(['a', 'c'])
+        for name, owner in owners.iteritems():
+            if owner != 'b':
+                self.assertEqual(ring.owner(name), owner)
+        self.assertIsNone(HashRing([]).owner('q'))
+
+    def test_membership(self):
+        a = ShardCoordinator('a', heartbeat_timeout=60)
+        b = ShardCoordinator('b', heartbeat_timeout=60)
+        # Alone, a worker handles every queue.
+        self.assertFalse(a.heartbeat())
+        self.assertTrue(a.owns(self.names[0]))
+        self.assertTrue(b.heartbeat())
+        self.assertTrue(a.heartbeat())
+        self.assertFalse(a.heartbeat())
+        for name in self.names:
+            self.assertNotEqual(a.owns(name), b.owns(name))
+
+        # Worker b stops sending heartbeats.
+        worker = GuardianWorker.query.get('b')
+        worker.heartbeat -= datetime.timedelta(seconds=120)
+        db_session.commit()
+        self.assertTrue(a.heartbeat())
+        self.assertTrue(all(a.owns(name) for name in self.names))
+
+        # It comes back, then leaves.
+        b.heartbeat()
+        self.assertTrue(a.heartbeat())
+        b.leave()
+        self.assertTrue(a.heartbeat())
+        self.assertEqual(a.ring.workers, frozenset(['a']))
+
+    def test_sync_shard(self):
+        for name in self.names[:20]:
+            db_session.add(Queue(name=name, size=0))
+        db_session.commit()
+
+        shard = ShardCoordinator('a')
+        shard.ring = HashRing(['a', 'b'])
+        mine = [name for name in self.names[:20] if shard.owns(name)]
+        others = [name for name in self.names[:20] if name not in mine]
+        checked = []
+
+        def owns(name):
+            checked.append(name)
+            return shard.owns(name)
+
+        # Only the first queue of the shard is still alive, along with the
+        # queues of the other shard.
+        rows = [('/', mine[0], 1, False)]
+        rows.extend(('/', name, None, None) for name in others)
+        deleted = sync_queues(db_session, rows, owns=owns)
+        db_session.commit()
+        self.assertEqual(sorted(name for vhost, name in deleted),
+                         sorted(mine[1:]))
+        remaining = dict((queue.name, queue.size)
+                         for queue in Queue.query.all())
+        self.assertEqual(set(remaining),
+                         set(self.names[:20]) - set(mine[1:]))
+        self.assertEqual(remaining[mine[0]], 1)
+        self.assertTrue(all(remaining[name] == 0 for name in others))
+        # Only the records of the missing queues were checked.
+        self.assertEqual(sorted(checked), sorted(mine[1:]))
+
+    def test_guardian_shard(self):
+        for name in self.names[:20]:
+            db_session.add(Queue(name=name, size=0))
+        db_session.commit()
+        ShardCoordinator('b').heartbeat()
+        shard = ShardCoordinator('a')
+        server = FakeManagementServer([
+            dict(name=name, vhost='/', messages=10, messages_ready=10,
+                 durable=False, consumers=0) for name in self.names[:20]])
+        server.start()
+        try:
+            guardian = PulseGuardian(
+                PulseManagementAPI(management_url=server.url, user='guest',
+                                   password='guest'),
+                emails=False, warn_queue_size=100, del_queue_size=200,
+                shard=shard)
+            guardian.monitor_queues(list(server.queues))
+            guardian.clear_deleted_queues()
+        finally:
+            server.stop()
+
+        # The records of the other shard are left as they are.
+        mine = set(name for name in self.names[:20] if shard.owns(name))
+        sizes = dict((queue.name, queue.size) for queue in Queue.query.all())
+        self.assertEqual(set(sizes), set(self.names[:20]))
+        for name, size in sizes.iteritems():
+            self.assertEqual(size, 10 if name in mine else 0)
+
+
+class VhostTest(unittest.TestCase):
+
+    """Tests the monitoring of queues spread over several vhosts, using a
+    local stand-in of the management API.
+    """
+
+    name = 'queue/{0}/q'.format(CONSUMER_USER)
+
+    def setUp(self):
+        dbinit.init_and_clear_db()
+        self.server = FakeManagementServer([
+            self._queue('/', 10), self._queue('a', 10),
+            self._queue('b', 500)]).start()
+        self.management_api = PulseManagementAPI(
+            management_url=self.server.url, user='guest', password='guest')
+        self.async_api = AsyncPulseManagementAPI(self.management_api)
+        self.guardian = PulseGuardian(self.management_api, emails=False,
+                                      warn_queue_size=100,
+                                      del_queue_size=200,
+                                      parallel_vhosts=True)
+
+    def tearDown(self):
+        self.async_api.close()
+        self.server.stop()
+
+    def _queue(self, vhost, messages):
+        return dict(name=self.name, vhost=vhost, messages=messages,
+                    messages_ready=messages, durable=False, consumers=0)
+
+    def _records(self):
+        return dict((queue.vhost, queue.size) for queue in
+                    Queue.query.filter(Queue.name == self.name))
+
+    def test_monitor_vhosts(self):
+        self.assertEqual(self.management_api.vhosts(), ['/', 'a', 'b'])
+        self.server.unauthorized = True
+        self.assertRaises(PulseManagementException,
+                          self.guardian.monitor_vhosts, self.async_api)
+        self.server.unauthorized = False
+        # Only the queue of vhost b is over the deletion threshold.
+        deleted = self.guardian.monitor_vhosts(self.async_api)
+        self.assertEqual(deleted, [('b', self.name)])
+        self.assertEqual(self._records(), {'/': 10, 'a': 10})
+        self.assertEqual(Queue.get_notifications(self.name, 'a'), [])
+
+        # Vhost a disappears along with its queue.
+        self.server.queues[:] = [q for q in self.server.queues
+                                 if q['vhost'] != 'a']
+        self.guardian.monitor_vhosts(self.async_api)
+        self.assertEqual(self._records(), {'/': 10})
+        self.assertEqual(self.guardian.snapshot,
+                         {('/', self.name): (10, False, None)})
+
+    def test_snapshot_reset(self):
+        self.guardian.monitor_vhosts(self.async_api)
+        # The policies change at every cycle; the snapshot must still cover
+        # every vhost when the deleted queues are cleared.
+        self.guardian.policies.refresh = lambda: True
+        self.guardian.monitor_vhosts(self.async_api)
+        self.assertEqual(self._records(), {'/': 10, 'a': 10})
+        self.assertEqual(set(self.guardian.snapshot),
+                         set([('/', self.name), ('a', self.name)]))
+
+
+class LeaderElectionTest(unittest.TestCase):
+
+    """Tests the election of the active guardian through a lease in the
+    database.
+    """
+
+    def setUp(self):
+        dbinit.init_and_clear_db()
+        GuardianLease.query.delete()
+        db_session.commit()
+
+    def test_lease(self):
+        a = LeaseElection('a', ttl=60)
+        b = LeaseElection('b', ttl=60)
+        self.assertTrue(a.campaign())
+        self.assertFalse(b.campaign())
+        self.assertTrue(a.campaign())
+
+        # The leader stops renewing its lease.
+        lease = GuardianLease.query.get('leader')
+        lease.expires_at -= datetime.timedelta(seconds=120)
+        db_session.commit()
+        self.assertTrue(b.campaign())
+        self.assertFalse(a.campaign())
+
+        b.resign()
+        self.assertFalse(b.is_leader)
+        self.assertTrue(a.campaign())
+
+    def test_standby(self):
+        leader = LeaseElection('leader', ttl=60)
+        self.assertTrue(leader.campaign())
+        guardian = PulseGuardian(None, emails=False,
+                                 election=LeaseElection(
+                                     'standby', ttl=60, retry_interval=0.05))
+        standby = threading.Thread(target=guardian.await_leadership)
+        standby.start()
+        time.sleep(0.3)
+        self.assertTrue(standby.is_alive())
+        self.assertFalse(guardian.is_leader())
+
+        leader.resign()
+        standby.join(5)
+        self.assertFalse(standby.is_alive())
+        self.assertTrue(guardian.is_leader())
+
+    def test_deletion_requires_leadership(self):
+        name = 'queue/{0}/q'.format(CONSUMER_USER)
+        server = FakeManagementServer([dict(
+            name=name, vhost='/', messages=500, messages_ready=500,
+            durable=False, consumers=0)]).start()
+        try:
+            election = LeaseElection('leader', ttl=60)
+            guardian = PulseGuardian(
+                PulseManagementAPI(management_url=server.url, user='guest',
+                                   password='guest'),
+                emails=False, warn_queue_size=100, del_queue_size=200,
+                election=election)
+            guardian.await_leadership()
+
+            # A standby took over during the cycle.
+            lease = GuardianLease.query.get('leader')
+            lease.holder = 'standby'
+            db_session.commit()
+            self.assertEqual(guardian.monitor_queues(server.queues), [])
+            self.assertEqual(len(server.queues), 1)
+            self.assertEqual(guardian._pending, set([('/', name)]))
+        finally:
+            server.stop()
+
+
 def setup_host():
     global pulse_cfg
 